@@ -4,8 +4,11 @@
 
 import numpy as np
 import math
+import warnings
 from scipy.integrate import quad
+from scipy.interpolate import CubicSpline
 import multifractal_parameter_values_pub as mpv
+import multifractal_hooks_pub as mhp
 
 # This rounds up / down float variables (haven't found this between basic functions, strange...).
 
@@ -85,19 +88,126 @@ def inverse_mellin_UM_integrand(z, x_o, C, alpha, scale):
     return function.real
 
 
-def inverse_mellin_UM(parameters, scale):
+# The Mellin transform of the UM PDF along the line q = 1.5 + z*i (the x_o independent part of the integrand above). Since x_o**(-q) = x_o**(-1.5)*exp(-i*z*log(x_o)), the same kernel values serve all the points x_o.
+
+def inverse_mellin_UM_kernel(z, C, alpha, scale):
+
+    q = 1.5 + np.asarray(z)*1j
+
+    return scale**(C/(alpha-1.0)*((q-1)**alpha-q+1))/(2*np.pi)
+
+
+# This evaluates the inverse Mellin transform for all the points x_o at once, using the trapezoidal rule on a shared quadrature grid of z >= 0 (the kernel is Hermitian, so the negative half of the line is its complex conjugate). The grid is truncated where the kernel falls below `accuracy' (relative to its value at z = 0), at most at z = `z_limit', and the grid step is halved (up to `max_nodes' nodes) until the result changes by less than `accuracy' (relative to the PDF maximum), which controls the aliasing error of the trapezoidal rule. The kernel decays only for the `scale' argument larger than 1 (the scale is the outer scale of the process times the extrapolation level) and C larger than 0, otherwise ValueError is raised. When the kernel has not decayed at z_limit or the step refinement has not converged with max_nodes nodes, the result is returned with a RuntimeWarning. The x_o points are processed in chunks to keep the memory modest, for large grids the sum is evaluated by FFT.
+
+def inverse_mellin_UM_bromwich(x, C, alpha, scale, accuracy, max_nodes = 2**15, z_limit = 2.0**15):
+
+    if (scale <= 1.0) | (C <= 0):
+        raise ValueError('The Mellin transform of the UM PDF does not decay along the integration line for scale = %g and C = %g (alpha = %g): the scale argument (the outer scale of the process times the extrapolation level) must be larger than 1 and C larger than 0.' % (scale, C, alpha))
+
+    x = np.asarray(x, dtype=float)
+    kernel_0 = np.abs(inverse_mellin_UM_kernel(0.0, C, alpha, scale))
+
+    z_max = 1.0
+    with np.errstate(over='ignore', invalid='ignore'):
+        while (np.abs(inverse_mellin_UM_kernel(z_max, C, alpha, scale)) > accuracy*kernel_0) & (z_max < z_limit):
+            z_max *= 2.0
+        tail = np.abs(inverse_mellin_UM_kernel(z_max, C, alpha, scale))/kernel_0
+
+    if not (tail <= accuracy):
+        warnings.warn('The Mellin transform of the UM PDF has decayed only to %g of its maximum at z_limit = %g (scale = %g, C = %g, alpha = %g), the accuracy %g is not reached.' % (tail, z_max, scale, C, alpha, accuracy), RuntimeWarning)
+
+    def nodes(n_nodes):
+
+        z = np.linspace(0.0, z_max, num=n_nodes+1)
+        weights = np.ones((n_nodes+1))*z_max/n_nodes
+        weights[[0, -1]] /= 2.0
+
+        return z, 2*weights*inverse_mellin_UM_kernel(z, C, alpha, scale)
+
+# Direct evaluation: a (points x nodes) matrix product, done in chunks of points.
+
+    def evaluate(points, n_nodes):
+
+        (z, kernel) = nodes(n_nodes)
+        log_points = np.log(points)
+        function = np.zeros((len(points)))
+
+        for chunk in range(0, len(points), 4096):
+            phase = np.multiply.outer(log_points[chunk:chunk+4096], z)
+            function[chunk:chunk+4096] = np.dot(np.cos(phase), kernel.real) + np.dot(np.sin(phase), kernel.imag)
+
+        return function*points**(-1.5)
+
+# FFT evaluation (for large grids): the sum is periodic in log(x_o) with the period 2*pi/step, it is sampled by the (oversampled) FFT on a uniform log(x_o) grid and interpolated to the points.
+
+    def evaluate_fft(points, n_nodes, oversampling = 16):
+
+        (z, kernel) = nodes(n_nodes)
+        log_points = np.log(points)
+        n_fft = oversampling*(n_nodes+1)
+        log_step = 2*np.pi/(z[1]*n_fft)
+        log_grid = np.min(log_points) + log_step*np.arange(0, int(round_up((np.max(log_points) - np.min(log_points))/log_step)) + 2)
+        transformed = np.fft.fft(kernel*np.exp(-1j*z*log_grid[0]), n=n_fft)[np.arange(0, len(log_grid)) % n_fft]    # beyond one period the sum repeats
+
+        return CubicSpline(log_grid, transformed.real)(log_points)*points**(-1.5)
+
+# The grid step is refined on a sub-sample of the points, then the full evaluation is done once.
+
+    test_points = x[::max(1, len(x)//500)]
+    n_nodes = 64
+    test_function = evaluate(test_points, n_nodes)
+    converged = False
+
+    while n_nodes < max_nodes:
+        n_nodes *= 2
+        refined_function = evaluate(test_points, n_nodes)
+        change = np.max(np.abs(refined_function - test_function))/max(np.max(np.abs(refined_function)), 1e-300)
+        converged = change <= accuracy
+        test_function = refined_function
+        if converged:
+            break
+
+    if not converged:
+        warnings.warn('The quadrature of the UM PDF has not converged with max_nodes = %d nodes (the last refinement changed it by %g of its maximum, the accuracy is %g).' % (max_nodes, change if n_nodes > 64 else np.inf, accuracy), RuntimeWarning)
+
+    mhp.progress('inverse_mellin_UM', nodes = n_nodes + 1, z_max = z_max, points = len(x), method = 'fft' if n_nodes*len(x) > 2**22 else 'direct')
+
+    if n_nodes*len(x) > 2**22:
+        return evaluate_fft(x, n_nodes)
+
+    return evaluate(x, n_nodes)
+
+
+# This returns the UM PDF values at the `argument' points (by default mpv.PDF_argument()). With method = 'bromwich' (default) all the points are obtained at once from the shared quadrature grid (see inverse_mellin_UM_bromwich(...)) with the target `accuracy', method = 'quad' integrates each point separately by the adaptive quadrature. A non-uniform (e.g. log-spaced, mpv.PDF_argument_log()) argument can be used to obtain the PDF with far fewer points.
+
+@mhp.timed('inverse_mellin_UM')
+def inverse_mellin_UM(parameters, scale, argument = None, accuracy = 1e-8, method = 'bromwich'):
 
     C = parameters[2]
     alpha = parameters[1]
 
-    x = mpv.PDF_argument()
-    function_transformed = np.zeros((len(x)))
-    index = 0
+    if argument is None:
+        x = mpv.PDF_argument()
+    else:
+        x = np.asarray(argument)
+
+    if method == 'bromwich':
+
+        function_transformed = inverse_mellin_UM_bromwich(x, C, alpha, scale, accuracy)
+
+    else:
+
+        function_transformed = np.zeros((len(x)))
+        index = 0
+        evaluations = 0
+
+        for x_o in x:
 
-    for x_o in x:
+            (function_transformed[index], error, information) = quad(inverse_mellin_UM_integrand, -np.inf, np.inf, args=(x_o, C, alpha, scale), full_output=1)[:3]
+            evaluations += information['neval']
+            index +=1 
 
-        function_transformed[index] = quad(inverse_mellin_UM_integrand, -np.inf, np.inf, args=(x_o, C, alpha, scale))[0]
-        index +=1 
+        mhp.progress('inverse_mellin_UM', nodes = evaluations, points = len(x), method = 'quad')
 
     function_transformed[function_transformed < 0] = 0  #clean numerical fluctuations 
 
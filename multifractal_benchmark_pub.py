@@ -0,0 +1,401 @@
+
+# This module benchmarks the stages of the multifractal analysis and of the extrapolation, so that the speedups (or regressions) can be compared across the versions of the code. Every stage is run on deterministic synthetic fields (see synthetic_field(...)) for all the combinations of the grid sizes, the land mask fractions and the numbers of iterations (for the extrapolation stages), and its wall time, peak memory (of the numpy arrays and python objects, from tracemalloc) and throughput (pixels per second) are recorded. The extrapolation stages are skipped (with the 'error' in their record) when the outer scale found by the analysis is too small for the number of iterations (see mbf.inverse_mellin_UM(...)). The throughput counts the pixels of the original grid for the analysis stages and of the extrapolated grid for the extrapolation stages (the PDF points for inverse_mellin_UM). The report is a JSON document, it is produced by benchmark(...) or by running the module as a script, e.g.:
+
+#   python multifractal_benchmark_pub.py --sizes 64 256 --mask-fractions 0 0.3 --iterations 1 2 --output report.json
+
+# The peak memory is measured by a separate (traced) run of the stage, as tracing slows down the python parts of the code. Tracing also adds to the memory of the python objects (the cluster bookkeeping of fluctuations_distribute(...) takes some hundreds of bytes per extrapolated pixel already without it), for the large grids the --no-memory option may be needed. The default grid sizes, mask fractions and numbers of iterations are given by benchmark_sizes(), benchmark_mask_fractions() and benchmark_iterations(), they are chosen so that the whole benchmark finishes in minutes. The extrapolated grid has (size*2**iterations)**2 pixels, e.g. --sizes 1024 --iterations 3 extrapolates 67 million pixels, which takes hours and some GB of memory, so the large grids are only run when asked for. The --check option only runs the checks of the results (see checks()), e.g. that the scaling methods agree (see check_scaling_methods(...)).
+
+
+
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import numpy as np
+import multifractal_scaling_essential_pub as mse
+import multifractal_basic_functions_pub as mbf
+import multifractal_extrapolate_functions_pub as mef
+import multifractal_parameter_values_pub as pa
+import multifractal_synthetic_pub as msy
+from multifractal_class_pub import multifractals
+from multifractal_extrapolation_pub import field_extrapolation
+
+def benchmark_sizes():
+    return (64, 256)
+
+def benchmark_mask_fractions():
+    return (0.0, 0.3)
+
+def benchmark_iterations():
+    return (1, 2)
+
+def benchmark_stages():
+    return ('fluxes', 'scaling', 'scaling_increments', 'UM_parameters', 'inverse_mellin_UM', 'fluxes_extrapolate', 'smoothen', 'fluctuations_distribute', 'field_extrapolation')
+
+
+
+# The deterministic synthetic UM field of the shape (size, size) with the parameters H, alpha, C_1 and its land mask covering the `mask_fraction' of the pixels (see msy.UM_field(...) and msy.land_mask(...)), the land pixels take the masking value. The same seed gives the same field.
+
+def synthetic_field(size, mask_fraction = 0.0, seed = 0, H = 0.33, alpha = 1.6, C_1 = 0.1, mask = None):
+
+    land = msy.land_mask((size, size), mask_fraction, seed) if mask_fraction > 0 else None
+
+    return msy.UM_field((size, size), H, alpha, C_1, seed = seed, land = land, mask = mask)
+
+
+
+# Runs the function (with the arguments) and returns its result and the dictionary with the wall time (in seconds) and, if `memory' is True, the peak memory (in bytes) of an additional traced run.
+
+def measure(function, arguments, memory = True):
+
+    start = time.perf_counter()
+    result = function(*arguments)
+    measurement = {'wall_time': time.perf_counter() - start}
+
+    if memory:
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        function(*arguments)
+        measurement['peak_memory'] = tracemalloc.get_traced_memory()[1] - baseline
+        if not tracing:
+            tracemalloc.stop()
+
+    return result, measurement
+
+
+
+# Benchmarks the stages for all the combinations of the grid sizes, mask fractions and numbers of iterations. The stage inputs are prepared once per combination (from the multifractal analysis of the synthetic field), so only the stage itself is measured. Returns the report (a dictionary that can be serialized to JSON), the `log' (e.g. sys.stderr) receives a line for every measurement.
+
+def benchmark(sizes = None, mask_fractions = None, iterations = None, stages = None, memory = True, seed = 0, log = None):
+
+    sizes = benchmark_sizes() if sizes is None else sizes
+    mask_fractions = benchmark_mask_fractions() if mask_fractions is None else mask_fractions
+    iterations = benchmark_iterations() if iterations is None else iterations
+    stages = benchmark_stages() if stages is None else stages
+    mask = pa.masking_value()
+    ratio_bound = pa.ratio_bound()
+    results = []
+    extrapolation_stages = ('inverse_mellin_UM', 'fluxes_extrapolate', 'smoothen', 'fluctuations_distribute', 'field_extrapolation')
+
+    def record(stage, size, mask_fraction, n_iterations, pixels, function, arguments):
+
+        (result, measurement) = measure(function, arguments, memory)
+        measurement.update({'stage': stage, 'size': size, 'mask_fraction': mask_fraction, 'n_iterations': n_iterations, 'pixels': int(pixels), 'pixels_per_second': pixels/max(measurement['wall_time'], 1e-12)})
+        results.append(measurement)
+
+        if log is not None:
+            log.write('%-24s size %5d  mask %.2f  iterations %s  %10.4f s\n' % (stage, size, mask_fraction, n_iterations, measurement['wall_time']))
+
+        return result
+
+    for size in sizes:
+        for mask_fraction in mask_fractions:
+
+            field = synthetic_field(size, mask_fraction, seed)
+            latitudes = np.zeros((size, size))
+            momenta_flux = pa.flux_momenta()
+            momenta_inc = pa.inc_momenta()
+            scales_inc = pa.scales(min(pa.max_scale(), size/4.0), pa.min_scale(), pa.scale_coeff())
+            analysis = multifractals(field, latitudes = latitudes, scales_inc = scales_inc, cache = False)
+            pixels = size**2
+
+# The analysis stages (independent of the number of iterations).
+
+            if 'fluxes' in stages:
+                record('fluxes', size, mask_fraction, None, pixels, mse.fluxes, (field, 1.0, latitudes, mask))
+            if 'scaling' in stages:
+                record('scaling', size, mask_fraction, None, pixels, mse.scaling, (analysis.fluxes(), momenta_flux, pa.max_scale(), pa.min_scale(), pa.scale_coeff(), 1.0, 'moment', latitudes, mask))
+            if 'scaling_increments' in stages:
+                record('scaling_increments', size, mask_fraction, None, pixels, mse.scaling_increments, (field, momenta_inc, scales_inc, latitudes, mask))
+            if 'UM_parameters' in stages:
+                record('UM_parameters', size, mask_fraction, None, pixels, mse.UM_parameters, (analysis.fluxes_scaling(), analysis.increments_scaling(), analysis.scales_fluxes(), analysis.scales_increments(), momenta_flux, momenta_inc))
+
+# The extrapolation stages.
+
+            parameters = analysis.UM_parameters()
+
+            for n_iterations in iterations:
+
+                level = 2**n_iterations
+                factor = parameters[4]*(1/2.0**n_iterations)**parameters[0]
+
+                try:
+                    PDF = mbf.inverse_mellin_UM(parameters, parameters[3]*level)
+                except ValueError as error:    # the outer scale of the field is too small for this number of iterations
+                    results.extend({'stage': stage, 'size': size, 'mask_fraction': mask_fraction, 'n_iterations': n_iterations, 'error': str(error)} for stage in stages if stage in extrapolation_stages)
+                    continue
+
+                if 'inverse_mellin_UM' in stages:
+                    record('inverse_mellin_UM', size, mask_fraction, n_iterations, len(PDF), mbf.inverse_mellin_UM, (parameters, parameters[3]*level))
+
+                flux_extrapolated = mef.fluxes_extrapolate(analysis.fluxes(), n_iterations, parameters, mask, seed = seed, PDF = PDF)
+                field_smooth = mef.smoothen(mef.upsampled_field(field, level), level, level, 2.0, mask)
+
+                if 'fluxes_extrapolate' in stages:
+                    record('fluxes_extrapolate', size, mask_fraction, n_iterations, pixels*level**2, mef.fluxes_extrapolate, (analysis.fluxes(), n_iterations, parameters, mask, seed, None, False, PDF))
+                if 'smoothen' in stages:
+                    record('smoothen', size, mask_fraction, n_iterations, pixels*level**2, lambda: mef.smoothen(mef.upsampled_field(field, level), level, level, 2.0, mask), ())
+                if 'fluctuations_distribute' in stages:
+                    record('fluctuations_distribute', size, mask_fraction, n_iterations, pixels*level**2, mef.fluctuations_distribute, (field_smooth, flux_extrapolated, factor, ratio_bound, mask, seed))
+                if 'field_extrapolation' in stages:
+                    record('field_extrapolation', size, mask_fraction, n_iterations, pixels*level**2, lambda: field_extrapolation(field, n_iterations, latitudes = latitudes, scales_inc = scales_inc, seed = seed, cache = False), ())
+
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(), 'memory': memory, 'seed': seed, 'results': results}
+
+
+
+# The check that the scaling(...) methods agree: the dyadic scales (scale_coeff = 2 from the scale 4) of method = 'pyramid' and of method = 'integral' lay the same boxes, so for every output (moment, variance, st_deviation) they must give the same values (up to the rounding) and the same shape. Returns the dictionary output -> the maximal relative difference, it raises AssertionError when the methods disagree by more than `rtol'.
+
+def check_scaling_methods(size = 128, mask_fraction = 0.3, seed = 0, rtol = 1e-8):
+
+    field = synthetic_field(size, mask_fraction, seed)
+    latitudes = np.zeros((size, size))
+    momenta = pa.flux_momenta()
+    differences = {}
+
+    for output in ('moment', 'variance', 'st_deviation'):
+
+        (integral, scales_integral) = mse.scaling(field, momenta, size/2.0, 4.0, 2.0, 1.0, output, latitudes, pa.masking_value(), method = 'integral')
+        (pyramid, scales_pyramid) = mse.scaling(field, momenta, size/2.0, 4.0, 2.0, 1.0, output, latitudes, pa.masking_value(), method = 'pyramid', intermediate = 0)
+
+        assert np.shape(integral) == np.shape(pyramid), 'the shapes of the %s scaling differ: %s (integral), %s (pyramid)' % (output, np.shape(integral), np.shape(pyramid))
+        assert np.allclose(scales_integral, scales_pyramid), 'the scales of the %s scaling differ' % output
+
+        differences[output] = float(np.max(np.abs(pyramid - integral)/np.maximum(np.abs(integral), 1e-300)))
+        assert differences[output] <= rtol, 'the %s scaling of the methods differs by %g' % (output, differences[output])
+
+    return differences
+
+
+
+# The check that the scaling(...) of a field with negative values (the synthetic field shifted below its mean) is the same with method = 'integral' and method = 'boxes' for output = 'moment', i.e. that the negative box means are kept (only the non-negative fields of double_trace_moments(...) have their box sums clipped at 0). Returns the maximal relative difference, it raises AssertionError when it exceeds `rtol'.
+
+def check_negative_scaling(size = 64, seed = 0, rtol = 1e-8):
+
+    field = synthetic_field(size, 0.0, seed)
+    field = field - 1.5*np.mean(field)
+    latitudes = np.zeros((size, size))
+    momenta = np.arange(1.0, 4.0)
+
+    (integral, scales_integral) = mse.scaling(field, momenta, size/2.0, 2.0, 1.5, 1.0, 'moment', latitudes, pa.masking_value(), method = 'integral')
+    (boxes, scales_boxes) = mse.scaling(field, momenta, size/2.0, 2.0, 1.5, 1.0, 'moment', latitudes, pa.masking_value(), method = 'boxes')
+
+    assert np.allclose(scales_integral, scales_boxes), 'the scales of the methods differ'
+    difference = float(np.max(np.abs(integral - boxes)/np.maximum(np.abs(boxes), 1e-300)))
+    assert difference <= rtol, 'the moments of the negative field differ by %g between the methods' % difference
+
+    return difference
+
+
+
+# The reference of the fluctuations_distribute(...) checks: the original pixel by pixel loop, which keeps the clusters as the integer labels of the whole grid (`case', 0 for the pixels not connected yet, -1 for the land) and relabels the grid on every connection of two clusters. The random numbers come from the numpy.random.Generator `generator'. With relabel_free = False a pixel not connected to anything that is connected to an existing cluster is relabelled alone (instead of all the pixels not connected yet, see mef.fluctuations_clusters(...)).
+
+def fluctuations_distribute_reference(field, flux, factor, ratio_bound, mask, generator, relabel_free = True):
+
+    field_extrapolated = np.array(field, dtype=float)
+    (region_height, region_width) = np.shape(field)
+    case = np.zeros((region_height, region_width))
+    case[field == mask] = -1
+    n_sea_pixels = np.count_nonzero(field != mask) + 0.0
+    ratio = 0.0
+    step = 1
+
+    def joined(pixel, neighbour):
+        return (case[neighbour] == case[pixel]) & (case[pixel]*case[neighbour] != 0)
+
+    while ratio < ratio_bound:
+
+        (lon, lat) = (int(round((region_width-1)*generator.random())), int(round((region_height-1)*generator.random())))
+
+        if case[lat, lon] < 0:
+            continue
+
+        (first_random, second_random) = (generator.random(), generator.random())
+        pixel = (lat, lon)
+        (east, west, south, north) = ((lat, lon+1), (lat, lon-1), (lat+1, lon), (lat-1, lon))
+
+        if (first_random > 0.5) & (lon+1 < region_width) & (lon-1 >= 0):
+            if joined(pixel, east) & joined(pixel, west):
+                first_random = 1.0 - first_random
+        if (first_random < 0.5) & (lat+1 < region_height) & (lat-1 >= 0):
+            if joined(pixel, south) & joined(pixel, north):
+                first_random = 1.0 - first_random
+        if (first_random > 0.5) & (second_random > 0.5) & (lon+1 < region_width):
+            if joined(pixel, east):
+                second_random = 1.0 - second_random
+        if (first_random > 0.5) & (second_random < 0.5) & (lon-1 >= 0):
+            if joined(pixel, west):
+                second_random = 1.0 - second_random
+        if (first_random < 0.5) & (second_random > 0.5) & (lat+1 < region_height):
+            if joined(pixel, south):
+                second_random = 1.0 - second_random
+        if (first_random < 0.5) & (second_random < 0.5) & (lat-1 >= 0):
+            if joined(pixel, north):
+                second_random = 1.0 - second_random
+
+        neighbour = None
+        if (first_random > 0.5) & (second_random > 0.5) & (lon+1 < region_width):
+            neighbour = east
+        if (first_random > 0.5) & (second_random < 0.5) & (lon-1 >= 0):
+            neighbour = west
+        if (first_random < 0.5) & (second_random > 0.5) & (lat+1 < region_height):
+            neighbour = south
+        if (first_random < 0.5) & (second_random < 0.5) & (lat-1 >= 0):
+            neighbour = north
+
+        if (neighbour is not None) and (field_extrapolated[neighbour] != mask) and not joined(pixel, neighbour):
+
+            delta = flux[pixel]*factor if field[neighbour] > field[pixel] else -flux[pixel]*factor
+
+            if case[neighbour] == 0:
+                field_extrapolated[neighbour] = field_extrapolated[pixel] + delta
+                if case[pixel] != 0:
+                    case[neighbour] = case[pixel]
+                else:
+                    case[neighbour] = step
+                    case[pixel] = step
+            else:
+                field_extrapolated[case == case[neighbour]] += field_extrapolated[pixel] + delta - field_extrapolated[neighbour]
+                case[case == case[neighbour]] = step
+                if relabel_free | (case[pixel] != 0):
+                    case[case == case[pixel]] = step
+                else:
+                    case[pixel] = step
+
+        ratio = np.count_nonzero(case > 0)/n_sea_pixels
+        step += 1
+
+    return field_extrapolated
+
+
+
+# The statistics of the fluctuations added to the smoothened field by the fluctuations_distribute(...) function: the fraction of the sea pixels changed, the mean and standard deviation of the deviations from the smoothened field and the mean absolute relative change of the means of the `block' x `block' blocks.
+
+def fluctuation_statistics(field_extrapolated, field, mask, block = 8):
+
+    sea = field != mask
+    deviation = (field_extrapolated - field)[sea]
+    blocks_extrapolated = mef.blocks(np.where(sea, field_extrapolated, 0.0), block, 0.0).sum(axis=(1, 3))
+    blocks_field = mef.blocks(np.where(sea, field, 0.0), block, 0.0).sum(axis=(1, 3))
+    relevant = blocks_field != 0
+
+    return {'changed': float(np.mean(deviation != 0)), 'mean': float(np.mean(deviation)), 'std': float(np.std(deviation)), 'block_change': float(np.mean(np.abs(blocks_extrapolated[relevant]/blocks_field[relevant] - 1)))}
+
+
+
+# The check that fluctuations_distribute(...) reproduces the distribution of the original loop (fluctuations_distribute_reference(...)): both are run `runs' times (with different seeds) on the same smoothened field and fluxes (of the synthetic field extrapolated by `n_iterations', with the fluctuation `factor'), the averages of their fluctuation_statistics(...) must agree within `tolerance' standard errors (of their difference over the runs). With relabel_free = False both run the corrected relabelling (see check_fluctuations_corrected(...)). Returns the averaged statistics of both.
+
+def check_fluctuations_distribution(size = 32, n_iterations = 1, factor = 0.05, runs = 40, seed = 0, tolerance = 4.0, relabel_free = True):
+
+    field = synthetic_field(size, 0.3, seed)
+    level = 2**n_iterations
+    field_smooth = mef.smoothen(mef.upsampled_field(field, level), level, level, 2.0, pa.masking_value())
+    flux = mef.upsampled_field(mse.fluxes(field, 1, np.zeros((size, size)), pa.masking_value()), level).materialize()
+    generator = np.random.default_rng(seed)
+    statistics = {'clusters': [], 'reference': []}
+
+    for run in range(0, runs):
+        statistics['clusters'].append(fluctuation_statistics(mef.fluctuations_distribute(field_smooth, flux, factor, pa.ratio_bound(), pa.masking_value(), seed = generator, relabel_free = relabel_free), field_smooth, pa.masking_value()))
+        statistics['reference'].append(fluctuation_statistics(fluctuations_distribute_reference(field_smooth, flux, factor, pa.ratio_bound(), pa.masking_value(), generator, relabel_free), field_smooth, pa.masking_value()))
+
+    averages = {}
+
+    for name in statistics['clusters'][0]:
+
+        (clusters, reference) = (np.array([run[name] for run in statistics['clusters']]), np.array([run[name] for run in statistics['reference']]))
+        error = np.sqrt((np.var(clusters) + np.var(reference))/runs)
+        averages[name] = {'clusters': float(np.mean(clusters)), 'reference': float(np.mean(reference))}
+        assert np.abs(np.mean(clusters) - np.mean(reference)) <= tolerance*max(error, 1e-12), 'the %s of the fluctuations differs from the original loop: %g and %g' % (name, np.mean(clusters), np.mean(reference))
+
+    return averages
+
+
+
+# The check of the corrected relabelling (relabel_free = False, see mef.fluctuations_clusters(...)): it must reproduce the distribution of the corrected original loop (on a smaller grid, as the reference relabels the grid on every connection until the ratio_bound is reached) and, unlike the original, actually connect (and change) at least the ratio_bound of the sea pixels. Returns the averaged statistics (see check_fluctuations_distribution(...)).
+
+def check_fluctuations_corrected(size = 12, runs = 40, seed = 0):
+
+    averages = check_fluctuations_distribution(size, runs = runs, seed = seed, relabel_free = False)
+    assert averages['changed']['clusters'] >= 0.9*pa.ratio_bound(), 'the corrected relabelling changed only %g of the sea pixels' % averages['changed']['clusters']
+
+    return averages
+
+
+
+# The mean absolute step between the neighbouring sea pixels of the extrapolated `field' across the tile borders (every `tile_size' pixels of the extrapolated grid), divided by that across the other borders of the upsampled blocks (every `level' pixels, which are not tile borders), i.e. of the same phase of the smoothening. It is about 1 when the tile borders are not seen in the field.
+
+def seam_ratio(field, tile_size, level, mask):
+
+    sea = field != mask
+    (steps_seam, steps_block) = ([], [])
+
+    for axis in (0, 1):
+
+        steps = np.abs(np.diff(field, axis = axis))
+        valid = np.logical_and(np.delete(sea, 0, axis), np.delete(sea, -1, axis))
+        position = np.arange(1, np.shape(field)[axis])
+        seam = position % tile_size == 0
+        block = np.logical_and(position % level == 0, np.logical_not(seam))
+        steps_seam.append(np.compress(seam, steps, axis)[np.compress(seam, valid, axis)])
+        steps_block.append(np.compress(block, steps, axis)[np.compress(block, valid, axis)])
+
+    return np.mean(np.concatenate(steps_seam))/np.mean(np.concatenate(steps_block))
+
+
+
+# The check that the tiles of the tiled extrapolation (field_extrapolation(...) with the tile_size) are not seen in the result: the seam_ratio(...) of the tiled and of the serial extrapolation of the synthetic field (averaged over `runs' seeds, with the same relabel_free) must agree within `tolerance'. Returns both averaged ratios.
+
+def check_tiled_seams(size = 256, n_iterations = 1, tile_size = 16, runs = 3, seed = 0, tolerance = 0.15, relabel_free = True):
+
+    field = synthetic_field(size, 0.3, seed)
+    analysis = multifractals(field)
+    level = 2**n_iterations
+    ratios = {'tiled': [], 'serial': []}
+
+    for run in range(0, runs):
+        ratios['tiled'].append(seam_ratio(field_extrapolation(field, n_iterations, analysis = analysis, seed = seed + run, relabel_free = relabel_free, tile_size = tile_size, n_workers = 1), tile_size*level, level, pa.masking_value()))
+        ratios['serial'].append(seam_ratio(field_extrapolation(field, n_iterations, analysis = analysis, seed = seed + run, relabel_free = relabel_free), tile_size*level, level, pa.masking_value()))
+
+    averages = dict((name, float(np.mean(values))) for (name, values) in ratios.items())
+    assert np.abs(averages['tiled'] - averages['serial']) <= tolerance, 'the tile borders are seen in the tiled extrapolation: seam ratio %g against %g of the serial one' % (averages['tiled'], averages['serial'])
+
+    return averages
+
+
+
+# The checks run by the --check option, by their names.
+
+def checks():
+    return {'scaling_methods': check_scaling_methods, 'negative_scaling': check_negative_scaling, 'fluctuations_distribution': check_fluctuations_distribution, 'fluctuations_corrected': check_fluctuations_corrected, 'tiled_seams': check_tiled_seams}
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Benchmark the stages of the multifractal analysis and extrapolation, the report is printed (or written) as JSON.')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = benchmark_sizes())
+    parser.add_argument('--mask-fractions', type = float, nargs = '+', default = benchmark_mask_fractions())
+    parser.add_argument('--iterations', type = int, nargs = '+', default = benchmark_iterations())
+    parser.add_argument('--stages', nargs = '+', default = benchmark_stages(), choices = benchmark_stages())
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--no-memory', action = 'store_true', help = 'skip the (slower) traced runs measuring the peak memory')
+    parser.add_argument('--output', help = 'the JSON file of the report (default: standard output)')
+    parser.add_argument('--check', action = 'store_true', help = 'only run the checks (see checks())')
+    arguments = parser.parse_args()
+
+    if arguments.check:
+        json.dump(dict((name, check(seed = arguments.seed)) for (name, check) in checks().items()), sys.stdout, indent = 1)
+        sys.exit(0)
+
+    report = benchmark(arguments.sizes, arguments.mask_fractions, arguments.iterations, arguments.stages, not arguments.no_memory, arguments.seed, sys.stderr)
+
+    if arguments.output is None:
+        json.dump(report, sys.stdout, indent = 1)
+    else:
+        with open(arguments.output, 'w') as output:
+            json.dump(report, output, indent = 1)
@@ -0,0 +1,111 @@
+
+# This module provides the persistent (on-disk) cache of the multifractal analysis results, used by the multifractals class (module multifractal_class_pub). The results are stored as .npz files in the cache directory (by default pa.cache_directory()), each file is addressed by the hash of everything the analysis depends on: the field, the latitudes, the mask and all the analysis settings (momenta, scales, scale coefficient). When the total size of the cache exceeds the limit (by default pa.cache_size(), in bytes), the least recently used results are removed.
+
+
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+import multifractal_parameter_values_pub as pa
+
+# The version of the stored results, it is a part of every key, so that the results of an older code are never used.
+
+CACHE_VERSION = 1
+
+
+
+# The key of the analysis: the SHA-256 hash (hexadecimal string) of the type, shape and bytes of all the `items' (arrays or numbers) in the given order.
+
+def cache_key(*items):
+
+    digest = hashlib.sha256(('multifractals-%d' % CACHE_VERSION).encode())
+
+    for item in items:
+        item = np.ascontiguousarray(item)
+        digest.update(('%s%s' % (item.dtype.str, np.shape(item))).encode())
+        digest.update(item.tobytes())
+
+    return digest.hexdigest()
+
+
+
+# The path of the cached result with the given key.
+
+def cache_path(key, directory = None):
+
+    return os.path.join(pa.cache_directory() if directory is None else directory, key + '.npz')
+
+
+
+# Returns the dictionary of the arrays stored under the key, or None if the key is not in the cache (or the stored file is unreadable). The access time of the result is updated, as it is used by the LRU eviction.
+
+def cache_load(key, directory = None):
+
+    path = cache_path(key, directory)
+
+    try:
+        with np.load(path) as stored:
+            arrays = dict((name, stored[name]) for name in stored.files)
+        os.utime(path)
+    except (OSError, ValueError, EOFError):
+        return None
+
+    return arrays
+
+
+
+# Stores the dictionary of arrays under the key. The file is written under a temporary name and then renamed, so an interrupted (or a concurrent) run never leaves a broken result in the cache. Then the least recently used results are evicted until the cache fits into `max_size' bytes.
+
+def cache_store(key, arrays, directory = None, max_size = None):
+
+    path = cache_path(key, directory)
+    directory = os.path.dirname(path)
+
+    try:
+        os.makedirs(directory, exist_ok = True)
+        (handle, temporary) = tempfile.mkstemp(dir = directory, suffix = '.tmp')
+        with os.fdopen(handle, 'wb') as output:
+            np.savez(output, **arrays)
+        os.replace(temporary, path)
+    except OSError:
+        return    # the cache is only an optimization, an unwritable cache directory is not an error
+
+    cache_evict(directory, pa.cache_size() if max_size is None else max_size)
+
+
+
+# Removes the least recently used results until the total size of the cache is at most `max_size' bytes.
+
+def cache_evict(directory = None, max_size = None):
+
+    directory = pa.cache_directory() if directory is None else directory
+    max_size = pa.cache_size() if max_size is None else max_size
+    entries = []
+
+    for name in os.listdir(directory):
+        if name.endswith('.npz'):
+            try:
+                status = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, name))
+
+    total_size = sum(entry[1] for entry in entries)
+
+    for (access, size, name) in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+        total_size -= size
+
+
+
+# Removes all the cached results.
+
+def cache_clear(directory = None):
+
+    cache_evict(directory, 0)
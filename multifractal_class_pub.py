@@ -1,13 +1,14 @@
 
 # Jozef Skakala, PML, 2016.
 
-# Here is the class that has a distribution ('field' argument) as an input and returns the complete multifractal information about the distribution. It computes the UM scaling using all the functions defined in the `multifractal_scaling_essential_pub' module. The names of the attributes are self-explanatory, perhaps with the exception of 'K', which is the standard notation for the moment scaling function. Besides the field distribution input, other optional arguments are 'latitudes', 'momenta_flux', 'momenta_inc', 'max_scale', 'min_scale', 'scale_coeff', 'mask' and 'scales_inc'. If the optional arguments are skipped, the arguments take their default values from the multifractal_parameter_pub module. The 'latitudes' argument is supplied to calculate the physical distance from the longitudal (spherical) coordinate distance. It can be also used to reflect on grid pixels that have unequal length in longitude and latitude directions. The increments scaling calculation can be computationally costly and therefore one can choose optimal range of scales for the analysis through the 'scales_inc' argument. It can be argued that the multiplicative (log-homogeneous) cascade from the default settings (pa.scales(...)) is for the increments scaling analysis far from optimal. One for example might prefer to use homogeneously spread scales with a suitable scaling gap. 
+# Here is the class that has a distribution ('field' argument) as an input and returns the complete multifractal information about the distribution. It computes the UM scaling using all the functions defined in the `multifractal_scaling_essential_pub' module. The names of the attributes are self-explanatory, perhaps with the exception of 'K', which is the standard notation for the moment scaling function. Besides the field distribution input, other optional arguments are 'latitudes', 'momenta_flux', 'momenta_inc', 'max_scale', 'min_scale', 'scale_coeff', 'mask', 'scales_inc', 'scaling_method', 'increments_method', 'momenta_DTM', 'etas', 'UM_method', 'plan' and 'cache'. If the optional arguments are skipped, the arguments take their default values from the multifractal_parameter_pub module. The field can also be a stack of fields on the same grid and with the same land mask (a 3-D (time, lat, lon) array, or an iterator of 2-D fields, e.g. daily fields). The geometry of the analysis is then shared, the stages are computed for the whole stack at once and all the attributes are returned stacked along the leading time axis (e.g. UM_parameters has the shape (time, 6)). The 'latitudes' argument is supplied to calculate the physical distance from the longitudal (spherical) coordinate distance. It can be also used to reflect on grid pixels that have unequal length in longitude and latitude directions. The increments scaling calculation can be computationally costly and therefore one can choose optimal range of scales for the analysis through the 'scales_inc' argument. It can be argued that the multiplicative (log-homogeneous) cascade from the default settings (pa.scales(...)) is for the increments scaling analysis far from optimal. One for example might prefer to use homogeneously spread scales with a suitable scaling gap. The stages of the analysis (increments scaling, fluxes, fluxes scaling, UM fit) are computed lazily, when their results are first asked for, so e.g. the fluxes() alone never compute the (costly) increments scaling. The compute(...) method computes selected stages at once. With the 'cache' argument the results of every stage are stored in the on-disk cache (module multifractal_cache_pub), addressed by the hash of the field, the latitudes, the mask and the settings the stage depends on, so analysing the same field again only loads the results. The 'scaling_method' argument selects the method of the flux scaling (see mse.scaling(...)), e.g. 'pyramid' for the dyadic coarse-graining pyramid. The 'increments_method' argument selects the increments scaling: 'circle' (the default, the increments around the circles, see mse.scaling_increments(...)) or 'haar' (the much cheaper Haar fluctuations from the integral images, also valid for -1 < H < 0, see mse.scaling_haar(...)). The spectrum() and spectral_parameters(...) methods give the quick-look (FFT-based) isotropic power spectrum of the field, its slope beta and the implied H. The double_trace_moments() and DTM_parameters() methods give the Double Trace Moment estimate of alpha and C_1 (the moments 'momenta_DTM' of the fluxes raised to the powers 'etas', by default pa.DTM_momenta() and pa.DTM_etas()), with 'UM_method' = 'DTM' (instead of the default 'grid') these alpha and C_1 replace the grid-search fit in the UM_parameters. The 'plan' argument is the geometry plan of the field (see multifractal_plan_pub), by default the plan is taken from the in-process cache of the plans (so the analyses of many fields on the same grid share it). The 'cache' argument can be False (the default, no cache), True (the directory pa.cache_directory()) or the cache directory path. 
 
 
 
 import numpy as np
 import multifractal_scaling_essential_pub as mse
 import multifractal_parameter_values_pub as pa
+import multifractal_cache_pub as mcp
 
 
 
@@ -15,6 +16,9 @@ import multifractal_parameter_values_pub as pa
 class multifractals:
 
     def __init__(self, field, **kwargs):
+
+        if not isinstance(field, np.ndarray):
+            field = np.stack(list(field))   # an iterator of 2-D fields is analysed as a stack
             
         self.field = field
 
@@ -23,7 +27,7 @@ class multifractals:
         if 'latitudes' in kwargs:          
             latitudes = kwargs['latitudes']
         else:
-            latitudes = np.zeros(np.shape(self.field))
+            latitudes = np.zeros(np.shape(self.field)[-2:])
 
         if 'momenta_flux' in kwargs:
             momenta_flux = kwargs['momenta_flux']
@@ -64,38 +68,187 @@ class multifractals:
         self.description = "Field with multifractal properties - the subject to the analysis."
         self.author = "JS"
 
-# Provides the multifractal scaling calculation..
+        if 'scaling_method' in kwargs:
+            scaling_method = kwargs['scaling_method']
+        else:
+            scaling_method = 'integral'
+
+        if 'increments_method' in kwargs:
+            increments_method = kwargs['increments_method']
+        else:
+            increments_method = 'circle'
+
+        if 'plan' in kwargs:
+            plan = kwargs['plan']
+        else:
+            plan = None
+
+        if 'momenta_DTM' in kwargs:
+            momenta_DTM = kwargs['momenta_DTM']
+        else:
+            momenta_DTM = pa.DTM_momenta()
+
+        if 'etas' in kwargs:
+            etas = kwargs['etas']
+        else:
+            etas = pa.DTM_etas()
+
+        if 'UM_method' in kwargs:
+            UM_method = kwargs['UM_method']
+        else:
+            UM_method = 'grid'
+
+        if 'cache' in kwargs:
+            cache = kwargs['cache']
+        else:
+            cache = False    # the on-disk cache is opt-in, the analysis writes nothing by default
+
+        if cache is True:
+            cache = pa.cache_directory()
+
+        self.latitudes = latitudes
+        self.mask = mask
+        self.cache = cache
+        self.plan = plan
+
+# The stages of the analysis: for every stage its dependencies (other stages), the settings it depends on and the function computing it from the results of the dependencies. The stages are computed lazily (only when their result is first needed) and only once.
+
+        self.stages = {
+            'increments_scaling': ((), (momenta_inc, scales_inc_an, increments_method), lambda: (mse.scaling_haar if increments_method == 'haar' else mse.scaling_increments)(self.field, momenta_inc, scales_inc_an, self.latitudes, self.mask, plan = self.plan)),
+            'fluxes': ((), (), lambda: (mse.fluxes(self.field, 1.0, self.latitudes, self.mask, self.plan),)),
+            'fluxes_scaling': (('fluxes',), (momenta_flux, max_scale, min_scale, scale_coeff, scaling_method), lambda: mse.scaling(self.results['fluxes'][0], momenta_flux, max_scale, min_scale, scale_coeff, 1.0, 'moment', self.latitudes, self.mask, method = scaling_method, plan = self.plan)),
+            'UM_fit': (('fluxes_scaling', 'increments_scaling') + (('DTM',) if UM_method == 'DTM' else ()), (momenta_flux, momenta_inc, UM_method), lambda: self.UM_fit(momenta_flux, momenta_inc)),
+            'DTM': (('fluxes',), (momenta_DTM, etas, max_scale, min_scale, scale_coeff, scaling_method), lambda: mse.double_trace_moments(self.results['fluxes'][0], momenta_DTM, etas, max_scale, min_scale, scale_coeff, self.latitudes, self.mask, method = scaling_method, plan = self.plan)),
+            'spectrum': ((), (), lambda: mse.spectral_parameters(self.field, self.latitudes, self.mask, plan = self.plan)),
+        }
+        self.results = {}
+        self.field_key = None
+
+
+
+# The UM fit (of every field of the stack), with alpha and C_1 from the grid search of mse.UM_fit(...) or (in the DTM mode) from the double trace moments.
 
-        (self.field_inc_scaling, self.scales_inc) = mse.scaling_increments(self.field, momenta_inc, scales_inc_an, latitudes, mask)          
+    def UM_fit(self, momenta_flux, momenta_inc):
 
-        self.flux = mse.fluxes(self.field, 1.0, latitudes, mask)
+        (flux_scaling, scales_flux) = self.results['fluxes_scaling']
+        (inc_scaling, scales_inc) = self.results['increments_scaling']
 
-        (self.flux_scaling, self.scales_flux) = mse.scaling(self.flux, momenta_flux, max_scale, min_scale, scale_coeff, 1.0, 'moment', latitudes, mask)  
+        if np.ndim(self.field) == 2:
+            (K, parameters) = mse.UM_parameters(flux_scaling, inc_scaling, scales_flux, scales_inc, momenta_flux, momenta_inc)
+        else:
+            fits = [mse.UM_parameters(flux_scaling_time, inc_scaling_time, scales_flux, scales_inc, momenta_flux, momenta_inc) for (flux_scaling_time, inc_scaling_time) in zip(flux_scaling, inc_scaling)]
+            (K, parameters) = (np.array([fit[0] for fit in fits]), np.array([fit[1] for fit in fits]))
+
+# In the DTM mode alpha, C_1 and the fit error are taken from the double trace moment analysis.
 
+        if 'DTM' in self.stages['UM_fit'][0]:
+            parameters[..., [1, 2, 5]] = self.results['DTM'][1]
 
-        (self.K, self.parameters) = mse.UM_parameters(self.flux_scaling, self.field_inc_scaling, self.scales_flux, self.scales_inc, momenta_flux, momenta_inc)
+        return K, parameters
 
 # The UM_parameters contains: [H, alpha, C_1, outer scale of process, fluctuations proportionality constant, UM fit error]. Please note that the outer_scale calculated through the UM_parameters function is in the units of the regional scale.
 
-        
+
+
+# Returns the results of the stage (a tuple of arrays), it computes the stage (and the stages it depends on) if needed. The results are looked up in the on-disk cache first, the cache key of the stage is the hash of the field, latitudes and mask, the stage name and the settings of the stage and of all its dependencies.
+
+    def stage(self, name):
+
+        if name not in self.results:
+
+            (dependencies, settings, function) = self.stages[name]
+
+            if self.cache:
+                stored = mcp.cache_load(self.stage_key(name), self.cache)
+            else:
+                stored = None
+
+            if stored is not None:
+                self.results[name] = tuple(stored['result_%d' % index] for index in range(0, len(stored)))
+            else:
+                for dependency in dependencies:
+                    self.stage(dependency)
+                self.results[name] = tuple(function())
+                if self.cache:
+                    mcp.cache_store(self.stage_key(name), dict(('result_%d' % index, result) for (index, result) in enumerate(self.results[name])), self.cache)
+
+        return self.results[name]
+
+
+
+    def stage_key(self, name):
+
+        if self.field_key is None:
+            self.field_key = mcp.cache_key(self.field, np.broadcast_to(self.latitudes, np.shape(self.field)[-2:]), self.mask)    # the field is hashed only once
+
+        (dependencies, settings, function) = self.stages[name]
+
+        return mcp.cache_key(self.field_key, name, *(settings + tuple(self.stage_key(dependency) for dependency in dependencies)))
+
+
+
+# Computes the selected stages (by default all) at once, e.g. compute(stages = ('fluxes', 'fluxes_scaling')). The stages are 'increments_scaling', 'fluxes', 'fluxes_scaling', 'UM_fit', 'DTM' and 'spectrum'. Returns the instance.
+
+    def compute(self, stages = None):
+
+        for name in (self.stages if stages is None else stages):
+            self.stage(name)
+
+        return self
+
+
 
     def fluxes(self):
-        return self.flux
+        return self.stage('fluxes')[0]
 
     def increments_scaling(self):
-        return self.field_inc_scaling
+        return self.stage('increments_scaling')[0]
 
     def fluxes_scaling(self):
-        return self.flux_scaling
+        return self.stage('fluxes_scaling')[0]
 
     def UM_parameters(self):
-        return self.parameters
+        return self.stage('UM_fit')[1]
 
     def scales_increments(self):    
-        return self.scales_inc
+        return self.stage('increments_scaling')[1]
 
     def scales_fluxes(self):
-        return self.scales_flux     
+        return self.stage('fluxes_scaling')[1]
 
     def moment_scaling_function(self):
-        return self.K
+        return self.stage('UM_fit')[0]
+
+# The double trace moment scaling functions K(q, eta) (of the shape (etas, momenta_DTM)) and the DTM parameters [alpha, C_1, fit error], see mse.double_trace_moments(...).
+
+    def double_trace_moments(self):
+        return self.stage('DTM')[0]
+
+    def DTM_parameters(self):
+        return self.stage('DTM')[1]
+
+# The isotropic power spectrum (the wavenumbers in cycles per pixel and the spectrum, see mse.spectrum(...)) and the spectral parameters [beta, H, k_1, k_2] (the spectral slope, the implied H and the fitted wavenumber range, see mse.spectral_parameters(...)). The spectral H ignores the intermittency by default, with intermittency = True it is corrected by K(2) = C_1/(alpha - 1)*(2**alpha - 2) of the UM fit (which computes the UM_fit stage).
+
+    def spectrum(self):
+        return self.stage('spectrum')[1:]
+
+    def spectral_parameters(self, intermittency = False):
+
+        parameters = np.array(self.stage('spectrum')[0])
+
+        if intermittency:
+            UM_parameters = np.reshape(self.UM_parameters(), (-1, 6))
+            K_2 = np.reshape(UM_parameters[:, 2]/(UM_parameters[:, 1] - 1)*(2**UM_parameters[:, 1] - 2), np.shape(parameters)[:-1])
+            parameters[..., 1] = (parameters[..., 0] - 1 + K_2)/2.0
+
+        return parameters
+
+# The attributes (as computed eagerly by the earlier versions of the class).
+
+    flux = property(fluxes)
+    field_inc_scaling = property(increments_scaling)
+    flux_scaling = property(fluxes_scaling)
+    parameters = property(UM_parameters)
+    scales_inc = property(scales_increments)
+    scales_flux = property(scales_fluxes)
+    K = property(moment_scaling_function)
@@ -5,129 +5,363 @@
 
 import numpy as np
 import multifractal_basic_functions_pub as mbf
-import random as rn
-from copy import deepcopy
 import multifractal_parameter_values_pub as pa
+from multiprocessing import shared_memory
+import multifractal_hooks_pub as mhp
 
 
 
-# This function lowers the resolution of a distribution, by a simple identity extrapolation. The code is self-explanatory.
+# This class is a lazy (zero-copy) view of the field at a lower resolution, as obtained by the simple identity extrapolation (every pixel is repeated `level' x `level' times). The values are read from the original field through the block-indexed accessor (view[lat_slice, lon_slice], view[int, int], or view[boolean array]), the full array is created only by materialize() (or when the view is converted by np.asarray). The comparisons view == value and view != value return the full boolean arrays (both are defined, as python would derive != from == by negating its result, which fails for the arrays).
+
+class upsampled_field:
+
+    def __init__(self, field, level):
+
+        self.field = np.asarray(field)
+        self.level = int(level)
+        self.shape = (np.shape(field)[0]*self.level, np.shape(field)[1]*self.level)
+        self.ndim = 2
+        self.dtype = self.field.dtype
+
+    def __getitem__(self, key):
+
+        if isinstance(key, np.ndarray) and (key.dtype == bool):
+            (lat, lon) = np.nonzero(key)
+            return self.field[lat//self.level, lon//self.level]
+
+        lat = np.arange(self.shape[0])[key[0]]//self.level
+        lon = np.arange(self.shape[1])[key[1]]//self.level
+
+        if (np.ndim(lat) > 0) & (np.ndim(lon) > 0):
+            return self.field[np.ix_(lat, lon)]
+
+        return self.field[lat, lon]
+
+    def __eq__(self, value):
+        return upsampled_field(self.field == value, self.level).materialize()
+
+    def __ne__(self, value):
+        return upsampled_field(self.field != value, self.level).materialize()
+
+    def __array__(self, dtype = None, copy = None):
+        return np.asarray(self.materialize(), dtype=dtype)
+
+    def materialize(self):
+        return np.repeat(np.repeat(self.field, self.level, axis=0), self.level, axis=1)
+
+# The integral images of the non-masked values and of the non-masked pixel counts (as in masked_box_mean(...)), computed separably from the cumulative sums of the original field.
+
+    def integral_images(self, mask):
+
+        sea = self.field != mask
+        tables = np.zeros((2, self.shape[0]+1, self.shape[1]+1))
+
+        for (table, layer) in zip(tables, (np.where(sea, self.field, 0.0), sea + 0.0)):
+
+            layer = np.vstack((layer, np.zeros((1, np.shape(layer)[1]))))
+            rows = np.arange(self.shape[0]+1)
+            cumulative = np.vstack((np.zeros((1, np.shape(layer)[1])), np.cumsum(layer, axis=0)))
+            partial = self.level*cumulative[rows//self.level] + (rows % self.level)[:, np.newaxis]*layer[rows//self.level]
+
+            partial = np.hstack((partial, np.zeros((np.shape(partial)[0], 1))))
+            columns = np.arange(self.shape[1]+1)
+            cumulative = np.hstack((np.zeros((np.shape(partial)[0], 1)), np.cumsum(partial, axis=1)))
+            table[:, :] = self.level*cumulative[:, columns//self.level] + (columns % self.level)*partial[:, columns//self.level]
+
+        return tables
+
+
+
+# This function lowers the resolution of a distribution, by a simple identity extrapolation. The code is self-explanatory. (Use the upsampled_field view directly to avoid creating the full array.)
 
 def lower_resolution(field, level):
+
+    return upsampled_field(field, level).materialize()
  
+
+
+# The masked box mean: for every pixel the mean of the non-masked field values in the box spanning from `below' pixels before to `above' pixels after the pixel (in both directions, clipped at the region boundaries). It is computed from the cumulative sums of the values and of the non-masked pixel counts, so its cost does not depend on the box size. The field can also be an upsampled_field view.
+
+def masked_box_mean(field, mask, below, above):
+
     (region_height, region_width) = np.shape(field)
-    field_low_resolution = np.zeros((level*region_height, level*region_width))
- 
-    for pixel_lon in range(0, region_width):
-        for pixel_lat in range(0, region_height): 
-     
-            field_low_resolution[pixel_lat*level:(pixel_lat+1)*level, pixel_lon*level:(pixel_lon+1)*level] = field[pixel_lat, pixel_lon]
-      
-    return field_low_resolution
- 
+
+    if isinstance(field, upsampled_field):
+        tables = field.integral_images(mask)
+    else:
+        sea = field != mask
+        tables = np.zeros((2, region_height+1, region_width+1))
+        tables[0, 1:, 1:] = np.cumsum(np.cumsum(np.where(sea, field, 0.0), axis=0), axis=1)
+        tables[1, 1:, 1:] = np.cumsum(np.cumsum(sea, axis=0), axis=1)
+
+    lat_1 = np.clip(np.arange(region_height) - below, 0, region_height)
+    lat_2 = np.clip(np.arange(region_height) + above + 1, 0, region_height)
+    lon_1 = np.clip(np.arange(region_width) - below, 0, region_width)
+    lon_2 = np.clip(np.arange(region_width) + above + 1, 0, region_width)
+
+# The box sums are taken first along the latitudes and then along the longitudes, the tables are overwritten on the way to keep the memory low.
+
+    for table in tables:
+        table[:region_height] = table[lat_2] - table[lat_1]
+        table[:region_height, :region_width] = table[:region_height, lon_2] - table[:region_height, lon_1]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return tables[0, :region_height, :region_width]/tables[1, :region_height, :region_width]
+
+
+
+# This reshapes the field into (n_blocks_lat, level, n_blocks_lon, level) blocks, the incomplete blocks at the region boundaries are padded by the `fill' value.
+
+def blocks(field, level, fill):
+
+    (region_height, region_width) = np.shape(field)
+    n_blocks_lat = int(mbf.round_up(region_height/(level+0.0)))
+    n_blocks_lon = int(mbf.round_up(region_width/(level+0.0)))
+    padded = np.full((n_blocks_lat*level, n_blocks_lon*level), fill, dtype=np.result_type(field, fill))
+    padded[:region_height, :region_width] = field
+
+    return np.reshape(padded, (n_blocks_lat, level, n_blocks_lon, level))
 
 
-# This function provides a smoothening algorithm. (Haven't found anything equally suitable.) The algirthms is based on obtaining a smoothened field using the `level_1'-scale averaging. The field is also set to recover the correct mean values at the `level_2' scale.
 
-def smoothen(field, level_1, level_2, power, mask):
+# The stretching step of the smoothen(...) function for all the `level' x `level' blocks at once: the smoothened values are stretched by the `power' law to recover the block means of the `field' (see the comments in smoothen(...)). The per-block min / max / mean are computed by reductions over the reshaped blocks. The blocks are processed in rows of blocks, at most `chunk_size' pixels at a time, so the `field' (possibly an upsampled_field view) is read only one chunk at a time.
+
+def stretch_blocks(field_smooth, field, level, power, mask, chunk_size = 2**22):
+
+    level = int(level)
+    chunk_rows = level*max(1, chunk_size//(level*np.shape(field)[1]*level))
+    field_stretched = np.zeros(np.shape(field_smooth))
+
+    for row in range(0, np.shape(field)[0], chunk_rows):
+        field_stretched[row:row+chunk_rows] = stretch_block_rows(field_smooth[row:row+chunk_rows], field[row:row+chunk_rows, :], level, power, mask)
+
+    return field_stretched
+
+
+def stretch_block_rows(field_smooth, field, level, power, mask):
+
+    (region_height, region_width) = np.shape(field)
+    level = int(level)
+    smooth = blocks(field_smooth, level, mask)
+    valid = blocks((field_smooth != mask), level, False)
+
+    n_block_pixels = np.sum(blocks(np.ones((region_height, region_width)), level, 0.0), axis=(1, 3))
+    relevant = np.sum(blocks(field, level, 0.0), axis=(1, 3))/n_block_pixels != mask   # if the pixel is on sea, go on
+    n_valid = np.sum(valid, axis=(1, 3))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+
+        mean_smooth = np.sum(np.where(valid, smooth, 0.0), axis=(1, 3))/n_valid
+        mean_field = np.sum(np.where(valid, blocks(field, level, 0.0), 0.0), axis=(1, 3))/n_valid
+        minimum = np.min(np.where(valid, smooth, np.inf), axis=(1, 3))
+        maximum = np.max(np.where(valid, smooth, -np.inf), axis=(1, 3))
+
+        increase = relevant & (mean_smooth < mean_field)
+        decrease = relevant & (mean_smooth > mean_field)
+
+# Case 1 (the smoothened value is smaller than the desired value) and Case 2 (bigger). The block values are expressed relative to the block min / max.
+
+        reference = np.where(increase, minimum, maximum)[:, np.newaxis, :, np.newaxis]
+        distance = np.where(valid, np.abs(smooth - reference), 0.0)**power
+        delta = np.sum(np.where(valid, distance, 0.0), axis=(1, 3))/n_valid
+        C = np.where(delta != 0, np.abs(mean_field - reference[:, 0, :, 0])/delta, 0.0)
+        sign = np.where(increase, 1.0, -1.0)
+
+    change = (increase | decrease)[:, np.newaxis, :, np.newaxis] & valid
+    stretched = np.where(change, reference + (sign*C)[:, np.newaxis, :, np.newaxis]*distance, smooth)
+    stretched = np.reshape(stretched, (np.shape(stretched)[0]*level, np.shape(stretched)[2]*level))
+
+    return stretched[:region_height, :region_width]
+
+
+
+# This function provides a smoothening algorithm. (Haven't found anything equally suitable.) The algirthms is based on obtaining a smoothened field using the `level_1'-scale averaging. The field is also set to recover the correct mean values at the `level_2' scale. The field can be an upsampled_field view, which is then never materialized. With method = 'box' (default) both the averaging (masked box filter) and the stretching (block reductions) are evaluated over whole arrays, method = 'loop' goes pixel by pixel and block by block.
+
+@mhp.timed('smoothen')
+def smoothen(field, level_1, level_2, power, mask, method = 'box'):
 
     step = (level_1-1)/2.0  # this is initial smoothening scale
+    below = int(np.ceil(step))    # the averaging box spans from `below' pixels before to `above' pixels after the pixel
+    above = int(np.floor(step))
     (region_height, region_width) = np.shape(field)
     field_smooth = np.zeros((region_height, region_width))   # this is soothened field
- 
-    for iterate in range(1, 6):   # there are 5 steps in which the smoothening procedure will be repeated. In each step the averaging and stretching approaches the ideally smoothened distribution more.
 
-        for subpixel_lon in range(0, region_width):
-            for subpixel_lat in range(0, region_height): 
+    if method == 'box':
+
+        for iterate in range(1, 6):   # there are 5 steps in which the smoothening procedure will be repeated. In each step the averaging and stretching approaches the ideally smoothened distribution more.
+
+            sea = field != mask
+            field_smooth[sea] = masked_box_mean(field, mask, below, above)[sea]     # This does the smoothening via supplying the averaged value at the level_1 scale.
+
+            if power != 0:
+                field_smooth = stretch_blocks(field_smooth, field, level_2, power, mask)
+
+            field = field_smooth.copy()
+            mhp.progress('smoothen', step = iterate, n_steps = 5)
+
+        return field_smooth
+
+    else:
+
+        for iterate in range(1, 6):   # there are 5 steps in which the smoothening procedure will be repeated. In each step the averaging and stretching approaches the ideally smoothened distribution more.
+
+            for subpixel_lon in range(0, region_width):
+                for subpixel_lat in range(0, region_height): 
      
-                if field[subpixel_lat, subpixel_lon] != mask:    # if the sub-pixel is sea then go on
+                    if field[subpixel_lat, subpixel_lon] != mask:    # if the sub-pixel is sea then go on
        
-                    field_box = field[max(0, subpixel_lat-step):min(region_height,subpixel_lat+step+1), max(0, subpixel_lon-step):min(region_width,subpixel_lon+step+1)]
-                    field_smooth[subpixel_lat, subpixel_lon] = np.mean(field_box[field_box != mask])     # This does the smoothening via supplying the averaged value at the level_1 scale.
+                        field_box = field[max(0, subpixel_lat-below):min(region_height,subpixel_lat+above+1), max(0, subpixel_lon-below):min(region_width,subpixel_lon+above+1)]
+                        field_smooth[subpixel_lat, subpixel_lon] = np.mean(field_box[field_box != mask])     # This does the smoothening via supplying the averaged value at the level_1 scale.
      
 # This next step tries to modify the smoothened values in order to recover the correct mean values at the scale `level_2'. It does so by stretching the differences between field values to obtain the right balance. The level of stretching is provided by the `power' value.
 
-        if power != 0:
-            for subpixel_lon in range(0, int(mbf.round_up(region_width/(level_2+0.0)))):
-                for subpixel_lat in range(0, int(mbf.round_up(region_height/(level_2+0.0)))): 
+            if power != 0:
+                for subpixel_lon in range(0, int(mbf.round_up(region_width/(level_2+0.0)))):
+                    for subpixel_lat in range(0, int(mbf.round_up(region_height/(level_2+0.0)))): 
        
-                    if np.mean(field[subpixel_lat*level_2 : min((subpixel_lat+1)*level_2, region_height), subpixel_lon*level_2 : min((subpixel_lon+1)*level_2, region_width)]) != mask:    # if the pixel is on sea, go on
+                        if np.mean(field[subpixel_lat*level_2 : min((subpixel_lat+1)*level_2, region_height), subpixel_lon*level_2 : min((subpixel_lon+1)*level_2, region_width)]) != mask:    # if the pixel is on sea, go on
        
-                        # This records the smoothened and the ``raw'' value to compare
+                            # This records the smoothened and the ``raw'' value to compare
 
-                        field_smooth_box = field_smooth[subpixel_lat*level_2 : min((subpixel_lat+1)*level_2, region_height), subpixel_lon*level_2 : min((subpixel_lon+1)*level_2, region_width)]
-                        field_box =  field[subpixel_lat*level_2 : min((subpixel_lat+1)*level_2, region_height), subpixel_lon*level_2 : min((subpixel_lon+1)*level_2, region_width)]
-                        mean_smooth = np.mean(field_smooth_box[field_smooth_box != mask])
-                        mean_field = np.mean(field_box[field_smooth_box != mask])
+                            field_smooth_box = field_smooth[subpixel_lat*level_2 : min((subpixel_lat+1)*level_2, region_height), subpixel_lon*level_2 : min((subpixel_lon+1)*level_2, region_width)]
+                            field_box =  field[subpixel_lat*level_2 : min((subpixel_lat+1)*level_2, region_height), subpixel_lon*level_2 : min((subpixel_lon+1)*level_2, region_width)]
+                            mean_smooth = np.mean(field_smooth_box[field_smooth_box != mask])
+                            mean_field = np.mean(field_box[field_smooth_box != mask])
     
-                       # if the values are not equal, this algorithm stretches the smoothened value to get the match. The two cases where the smoothened value is smaller / bigger than the desired value are dealt with separately.
+                           # if the values are not equal, this algorithm stretches the smoothened value to get the match. The two cases where the smoothened value is smaller / bigger than the desired value are dealt with separately.
 
-              # Case 1
+                  # Case 1
 
-                        if mean_smooth < mean_field:
+                            if mean_smooth < mean_field:
          
-                            delta = np.mean(np.abs(field_smooth_box[field_smooth_box != mask] - min(field_smooth_box[field_smooth_box != mask]))**power)     
+                                delta = np.mean(np.abs(field_smooth_box[field_smooth_box != mask] - min(field_smooth_box[field_smooth_box != mask]))**power)     
          
-                            if delta != 0:
-                                C = (mean_field - min(field_smooth_box[field_smooth_box != mask]))/delta
-                            else:
-                                C = 0
+                                if delta != 0:
+                                    C = (mean_field - min(field_smooth_box[field_smooth_box != mask]))/delta
+                                else:
+                                    C = 0
      
-                            field_smooth_box[field_smooth_box != mask] = min(field_smooth_box[field_smooth_box != mask]) + C*(field_smooth_box[field_smooth_box != mask]-min(field_smooth_box[field_smooth_box != mask]))**power   # C and power provide the stretching
+                                field_smooth_box[field_smooth_box != mask] = min(field_smooth_box[field_smooth_box != mask]) + C*(field_smooth_box[field_smooth_box != mask]-min(field_smooth_box[field_smooth_box != mask]))**power   # C and power provide the stretching
      
-               # Case 2
+                   # Case 2
     
-                        if mean_smooth > mean_field:
+                            if mean_smooth > mean_field:
      
-                            delta = np.mean(np.abs(field_smooth_box[field_smooth_box != mask] - max(field_smooth_box[field_smooth_box != mask]))**power)    
+                                delta = np.mean(np.abs(field_smooth_box[field_smooth_box != mask] - max(field_smooth_box[field_smooth_box != mask]))**power)    
     
-                            if delta != 0: 
-                                C = (max(field_smooth_box[field_smooth_box != mask])-mean_field)/delta 
-                            else: 
-                                C = 0
+                                if delta != 0: 
+                                    C = (max(field_smooth_box[field_smooth_box != mask])-mean_field)/delta 
+                                else: 
+                                    C = 0
       
-                            field_smooth_box[field_smooth_box != mask]= max(field_smooth_box[field_smooth_box != mask]) - C*(max(field_smooth_box[field_smooth_box != mask])-field_smooth_box[field_smooth_box != mask])**power
+                                field_smooth_box[field_smooth_box != mask]= max(field_smooth_box[field_smooth_box != mask]) - C*(max(field_smooth_box[field_smooth_box != mask])-field_smooth_box[field_smooth_box != mask])**power
   
      
-                        field_smooth[subpixel_lat*level_2: min((subpixel_lat+1)*level_2, region_height), subpixel_lon*level_2: min((subpixel_lon+1)*level_2, region_width)] = field_smooth_box
+                            field_smooth[subpixel_lat*level_2: min((subpixel_lat+1)*level_2, region_height), subpixel_lon*level_2: min((subpixel_lon+1)*level_2, region_width)] = field_smooth_box
      
     
-        field = field_smooth
+            field = field_smooth.copy()
      
     return field_smooth
  
 
 
 
-# This function redistributes the coordinates on the extrapolated smaller grid. It returns the coordinates of the smaller grid cells. `Info' variable contains information about whether longitudes, or latitudes are being extrapolated.
+# The 1-D index maps of the coordinate extrapolation: for every pixel of the extrapolated grid (along one axis with `n_pixels' original pixels) the original pixel below, the original pixel above (clipped at the region boundary) and the fraction of the distance between them.
+
+def coord_index_maps(n_pixels, n_iterations):
+
+    level = 2**n_iterations
+    pixels = np.arange(n_pixels*level)
+    lower = np.minimum(pixels//level, n_pixels-1)
+    upper = np.minimum(-(-pixels//level), n_pixels-1)
+    fraction = (pixels - lower*level)/(level+0.0)
+
+    return lower, upper, fraction
+
+
+
+# This function redistributes the coordinates on the extrapolated smaller grid. It returns the coordinates of the smaller grid cells. `Info' variable contains information about whether longitudes, or latitudes are being extrapolated. The coordinates are linearly interpolated along their own axis (longitudes along the rows, latitudes along the columns), using the 1-D index maps from coord_index_maps(...).
 
 def extrapolate_coord(coordinates, n_iterations, info):
 
+    coordinates = np.asarray(coordinates, dtype=float)
     (region_height, region_width) = np.shape(coordinates)
-    coordinates_extrapolated = np.zeros((region_height*2**n_iterations, region_width*2**n_iterations))
-     
-    for pix_lon in range(0, int(region_width*2**n_iterations)):
-        for pix_lat in range(0, int(region_height*2**n_iterations)):
-    
-            if info == 'longitudes':
-                coord_max = coordinates[min(mbf.round_up(pix_lat/(2.0**n_iterations)), region_height-1), min(round(pix_lon/(2.0**n_iterations)), region_width-1)]
-                coord_min = coordinates[min(mbf.round_down(pix_lat/(2.0**n_iterations)), region_height-1)][min(round(pix_lon/(2.0**n_iterations)), region_width-1)]
-                coordinates_extrapolated[pix_lat, pix_lon] = coord_min + (pix_lon - mbf.round_down(pix_lon/(2.0**n_iterations)))*(coord_max-coord_min)/(2.0**n_iterations)            
-            
-            if info == 'latitudes':
-                coord_max = coordinates[min(round(pix_lat/(2**n_iterations)), region_height-1)][min(mbf.round_up(pix_lon/(2**n_iterations)), region_width-1)]
-                coord_min = coordinates[min(round(pix_lat/(2**n_iterations)), region_height-1)][min(mbf.round_down(pix_lon/(2**n_iterations)), region_width-1)]
-                coordinates_extrapolated[pix_lat, pix_lon] = coord_min + (pix_lat - mbf.round_down(pix_lat/(2.0**n_iterations)))*(coord_max-coord_min)/(2.0**n_iterations)
-      
-    return coordinates_extrapolated  
+    (lower_lat, upper_lat, fraction_lat) = coord_index_maps(region_height, n_iterations)
+    (lower_lon, upper_lon, fraction_lon) = coord_index_maps(region_width, n_iterations)
+
+    if info == 'longitudes':
+        rows = coordinates[lower_lat, :]
+        coord_min = rows[:, lower_lon]
+        coord_max = rows[:, upper_lon]
+        return coord_min + fraction_lon*(coord_max - coord_min)
+
+    if info == 'latitudes':
+        columns = coordinates[:, lower_lon]
+        coord_min = columns[lower_lat, :]
+        coord_max = columns[upper_lat, :]
+        return coord_min + fraction_lat[:, np.newaxis]*(coord_max - coord_min)
+
 
 
+# This extrapolates both the latitudes and the longitudes in one pass (returned in this order). If `compact' = True and the grid is rectilinear (latitudes constant along the rows, longitudes constant along the columns), only the 1-D latitude and longitude axes of the extrapolated grid are returned, rather than the full 2-D arrays.
 
+def extrapolate_grid(latitudes, longitudes, n_iterations, compact = False):
 
-# This stochastically redistributes fluxes at a lower scale using the universal multifractal model.
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    (region_height, region_width) = np.shape(latitudes)
+    (lower_lat, upper_lat, fraction_lat) = coord_index_maps(region_height, n_iterations)
+    (lower_lon, upper_lon, fraction_lon) = coord_index_maps(region_width, n_iterations)
 
+    if compact and np.all(latitudes == latitudes[:, :1]) and np.all(longitudes == longitudes[:1, :]):
+        latitude_axis = latitudes[lower_lat, 0] + fraction_lat*(latitudes[upper_lat, 0] - latitudes[lower_lat, 0])
+        longitude_axis = longitudes[0, lower_lon] + fraction_lon*(longitudes[0, upper_lon] - longitudes[0, lower_lon])
+        return latitude_axis, longitude_axis
 
-def fluxes_extrapolate(flux, n_iterations, UM_parameters, mask):
+    return extrapolate_coord(latitudes, n_iterations, 'latitudes'), extrapolate_coord(longitudes, n_iterations, 'longitudes')
+
+
+
+
+# This class draws random values from a PDF given at the `argument' nodes (by default pa.PDF_argument()). The cumulative distribution is built once, after that any number of values is drawn by a single vectorized inversion of the CDF. Without interpolation the values are the PDF nodes themselves (each node carrying the probability PDF*node width, which for the uniform default grid is the same as PDF/sum(PDF)), with `interpolate' = True the values are spread uniformly between the neighbouring nodes. The `seed' can be an integer or a numpy.random.Generator, so that the draws are reproducible.
+
+class PDF_sampler:
+
+    def __init__(self, PDF, argument = None, interpolate = False, seed = None):
+
+        if argument is None:
+            argument = pa.PDF_argument()
+
+        self.argument = np.asarray(argument, dtype=float)
+        self.interpolate = interpolate
+        self.generator = np.random.default_rng(seed)
+
+        if interpolate:
+            probability = (PDF[1:] + PDF[:-1])*np.diff(self.argument)/2.0    # the probability of the intervals between the nodes
+            self.cdf = np.concatenate(([0.0], np.cumsum(probability)))
+        else:
+            probability = PDF*np.gradient(self.argument)
+            self.cdf = np.cumsum(probability)
+
+        self.cdf = self.cdf/self.cdf[-1]
+
+    def sample(self, size):
+
+        uniform = self.generator.random(size)
+
+        if self.interpolate:
+            return np.interp(uniform, self.cdf, self.argument)
+
+        return self.argument[np.minimum(np.searchsorted(self.cdf, uniform, side='right'), len(self.argument)-1)]
+
+
+
+# This stochastically redistributes fluxes at a lower scale using the universal multifractal model. The multiplicative factors for the whole extrapolated grid are drawn at once by the PDF_sampler. The optional `seed' (integer or numpy.random.Generator) makes the extrapolation reproducible, the optional `argument' gives the PDF nodes (e.g. pa.PDF_argument_log()) and `interpolate' is passed to the PDF_sampler. An already computed `PDF' (at the `argument' nodes) can be supplied to skip the inverse Mellin transform.
+
+
+@mhp.timed('fluxes_extrapolate')
+def fluxes_extrapolate(flux, n_iterations, UM_parameters, mask, seed = None, argument = None, interpolate = False, PDF = None):
 
  # This reads all the multifractal information
 
@@ -140,283 +374,271 @@ def fluxes_extrapolate(flux, n_iterations, UM_parameters, mask):
 
     scale = R*2**n_iterations
 
- # Obtain the real PDF from the inverse Mellin transform.
+ # Obtain the real PDF from the inverse Mellin transform and build its sampler.
 
-    PDF = mbf.inverse_mellin_UM(UM_parameters, scale)
+    if PDF is None:
+        PDF = mbf.inverse_mellin_UM(UM_parameters, scale, argument = argument)
+    sampler = PDF_sampler(PDF, argument = argument, interpolate = interpolate, seed = seed)
 
- # The basic regional parameters.
+ # The flux at the extrapolated grid before the redistribution (every pixel carries the flux of its parent pixel).
 
-    region_width = int(np.shape(flux)[0]*2**n_iterations)
-    region_height = int(np.shape(flux)[1]*2**n_iterations)
+    flux_parent = upsampled_field(flux, 2**n_iterations)
 
   # The outcome of the extrapolation.
 
-    flux_extrapolated = np.ones((region_height, region_width))*mask
+    flux_extrapolated = np.ones(np.shape(flux_parent))*mask
 
-  # The loop that runs through individual pixels on the extrapolated grid.
+  # All the factors are drawn at once (in the row-major order of the sea pixels) and determine the flux at the lower scales.
 
-    for lat in range(0, region_height):
+    sea = flux_parent != mask
+    flux_extrapolated[sea] = sampler.sample(np.count_nonzero(sea))*flux_parent[sea]
 
-        for lon in range(0, region_width):
 
-            if flux[lat/2**n_iterations, lon/2**n_iterations] != mask:
+    return flux_extrapolated
     
-                factor = np.random.choice(pa.PDF_argument(), p = PDF/sum(PDF))  # obtain from the randomly generated value the extrapolation factor.
-                flux_extrapolated[lat, lon] = factor*flux[lat/2**n_iterations, lon/2**n_iterations]  # Determine the flux at the lower scales.
 
 
-    return flux_extrapolated
-    
 
+# This class keeps the clusters of the connected pixels for the fluctuations_distribute(...) function as a disjoint-set forest (union by size, path compression). Every pixel stores its shift relative to its parent, so shifting a whole cluster is a single update of the cluster root, and the shifts are applied to the pixel values lazily. The forest is sparse: only the pixels that were connected are stored (in dictionaries), the values are read from the `values' array (which can be memory-mapped) when they are needed, so the bookkeeping does not grow with the grid but with the number of the connected pixels. The number of connected pixels (pixels in clusters of at least two) is kept as a running counter. The pixels are addressed by their flat (row-major) index.
 
+class pixel_clusters:
 
-# This function stochastically redistributes fluctuations corresponding to fluxes at a lower scale. 
+    def __init__(self, values):
 
+        self.values = np.ravel(values)
+        self.shape = np.shape(values)
+        self.parent = {}    # the pixels that are not the roots of their clusters
+        self.size = {}      # the roots of the clusters of at least two pixels
+        self.shift = {}
+        self.n_connected = 0
 
-def fluctuations_distribute(field, flux, factor, ratio_bound, mask):
+# This returns the root of the pixel's cluster and the total shift of the pixel. The path to the root is compressed.
 
-# Define the extrapolated field and regional parameters.
+    def find(self, pixel):
 
-    field_extrapolated = deepcopy(field)
-    (region_height, region_width) = np.shape(field)
+        path = []
+        root = pixel
 
-    case = np.zeros((region_height, region_width))    # This variable stores the information about the pixels that were connected. The pixels that were connected are the ones where the `case' variable has the same integer value. The value grown with the `step' variable.
-    case[field == mask] = - 1   # Wherever the pixels are irrelevant (land), the value of case is negative one.
-    ratio = 0.0       # `ratio' measures the ratio of pixels at which the fluctuations have been redistributed.
-    n_sea_pixels = len(field[field != mask]) + 0.0   # This is number of relevant pixels (sea).
-    step = 1  # The value of `step' variable is initially set to 1.
-          
+        while root in self.parent:
+            path.append(root)
+            root = self.parent[root]
 
-# This is the main while loop which runs until the pixels where the fluctuations have been redistributed reach the desired ratio, when compared to all the relevant (sea) pixels. 
+        shift = 0.0
 
-    while ratio < ratio_bound:
+        for node in reversed(path):
+            shift += self.shift[node]
+            self.shift[node] = shift
+            self.parent[node] = root
 
-      # This randomly selects a grid point.
-          
-        pix_lon = round((region_width-1)*rn.random())
-        pix_lat = round((region_height-1)*rn.random())
+        if pixel == root:
+            return root, self.shift.get(root, 0.0)
 
-      # If the grid point is relevant (sea) please go on...
-            
-        if case[pix_lat, pix_lon] >= 0:
+        return root, self.shift[pixel] + self.shift.get(root, 0.0)
+
+    def value(self, pixel):
+        return float(self.values[pixel]) + self.find(pixel)[1]
+
+    def cluster_size(self, pixel):
+        return self.size.get(self.find(pixel)[0], 1)
+
+    def connected(self, pixel_1, pixel_2):
+        return self.find(pixel_1)[0] == self.find(pixel_2)[0]
+
+# This connects the `neighbour' pixel to the `pixel', the neighbour's whole cluster is shifted so that value(neighbour) = value(pixel) + delta. Nothing is done if the two pixels are already connected.
+
+    def link(self, pixel, neighbour, delta):
+
+        (root_pixel, shift_pixel) = self.find(pixel)
+        (root_neighbour, shift_neighbour) = self.find(neighbour)
+
+        if root_pixel == root_neighbour:
+            return
+
+        self.shift[root_neighbour] = self.shift.get(root_neighbour, 0.0) + float(self.values[pixel]) + shift_pixel + delta - float(self.values[neighbour]) - shift_neighbour
+        (size_pixel, size_neighbour) = (self.size.pop(root_pixel, 1), self.size.pop(root_neighbour, 1))
+        self.n_connected += (size_pixel == 1) + (size_neighbour == 1)
+
+        if size_pixel < size_neighbour:
+            (root_pixel, root_neighbour) = (root_neighbour, root_pixel)
+
+        self.shift[root_neighbour] = self.shift.get(root_neighbour, 0.0) - self.shift.get(root_pixel, 0.0)
+        self.parent[root_neighbour] = root_pixel
+        self.size[root_pixel] = size_pixel + size_neighbour
+
+# This adds the shifts of the connected pixels to the `field' (in place, it can be memory-mapped), which has the shape of the values.
+
+    def apply(self, field):
+
+        pixels = list(set(self.parent) | set(self.shift))
+
+        if pixels:
+            np.reshape(field, (-1,))[pixels] += [self.find(pixel)[1] for pixel in pixels]
+
+# The field with all the cluster shifts applied.
+
+    def field(self):
+
+        field = np.array(np.reshape(self.values, self.shape), dtype=float)
+        self.apply(field)
+
+        return field
+
+
+
+# This function stochastically redistributes fluctuations corresponding to fluxes at a lower scale. The connected pixels are kept as pixel_clusters, so connecting two clusters costs (almost) O(1), rather than a scan of the whole grid (see fluctuations_clusters(...)). The optional `seed' (integer or numpy.random.Generator) makes the distribution reproducible, `relabel_free' (default pa.relabel_free()) selects whether the loop ends as in the original code (see fluctuations_clusters(...)).
+
+
+def fluctuations_distribute(field, flux, factor, ratio_bound, mask, seed = None, relabel_free = None):
+
+    sea = field != mask
+    field_extrapolated = fluctuations_clusters(field, flux, factor, ratio_bound, mask, seed, relabel_free).field()
+    field_extrapolated[~sea] = field[~sea]
             
-      # This randomly selects a neighbouring point: `first random' whether we move by 1 in longitudal direction, or latitudal direction. `Second random' determines whether we move by plus or minus one. 
-          
-            first_random = rn.random()
-            second_random = rn.random()
-        
-          # To save us computational time, these conditions look on whether the randomly selected couples of points were already connected, and if they were it automatically flips the direction in the opposite.
-      
-            if (first_random > 0.5) & (pix_lon+1 < region_width) &  (pix_lon-1 >= 0): 
-                if (case[pix_lat, pix_lon+1] == case[pix_lat, pix_lon]) & (case[pix_lat, pix_lon-1] == case[pix_lat, pix_lon]) & (case[pix_lat, pix_lon]*case[pix_lat, pix_lon-1]*case[pix_lat, pix_lon+1] != 0): 
-                
-                    first_random = 1.0 - first_random
-                
-            if (first_random < 0.5) & (pix_lat+1 < region_height) & (pix_lat-1 >= 0):
-                if (case[pix_lat+1, pix_lon] == case[pix_lat, pix_lon]) & (case[pix_lat-1, pix_lon] == case[pix_lat, pix_lon]) & (case[pix_lat, pix_lon]*case[pix_lat-1, pix_lon]*case[pix_lat+1, pix_lon] != 0): 
-                  
-                    first_random = 1.0 - first_random
+    return field_extrapolated
 
-          # Again, to save computational time, the same thing is done with `second randomn' value (it automatically flips the motion to the opposite if the randomply selected option was realised).
-               
-            if (first_random > 0.5) & (second_random > 0.5) & (pix_lon+1 < region_width):
-                if  (case[pix_lat, pix_lon+1] == case[pix_lat, pix_lon]) & (case[pix_lat, pix_lon]*case[pix_lat, pix_lon+1] != 0): 
-                
-                    second_random = 1.0 - second_random
-                
-            if (first_random > 0.5) & (second_random < 0.5) & (pix_lon-1 >= 0):
-                if (case[pix_lat, pix_lon-1] == case[pix_lat, pix_lon]) & (case[pix_lat, pix_lon]*case[pix_lat, pix_lon-1] != 0): 
-                
-                    second_random = 1.0 - second_random
-                
-            if (first_random < 0.5) & (second_random > 0.5) & (pix_lat+1 < region_height):
-                if (case[pix_lat+1, pix_lon] == case[pix_lat, pix_lon]) & (case[pix_lat+1, pix_lon]*case[pix_lat, pix_lon] != 0): 
-  
-                    second_random = 1.0 - second_random
-                
-            if (first_random < 0.5) & (second_random < 0.5) & (pix_lat-1 >= 0): 
-                if (case[pix_lat-1, pix_lon] == case[pix_lat, pix_lon]) & (case[pix_lat, pix_lon]*case[pix_lat-1, pix_lon] != 0):
-        
-                    second_random = 1.0 - second_random
- 
 
 
-           # This is the part where the fluctuations are redistributed using the fluxes and the smoothened field information.
+# This does the work of fluctuations_distribute(...) and returns the pixel_clusters (whose shifts can then be applied in place, e.g. to a memory-mapped field, see pixel_clusters.apply(...)). It is the same random process as the original pixel by pixel loop (which kept the clusters as the labels of the whole grid): a random grid point and a random neighbour are selected (the direction is flipped towards the pixels not yet connected to it) and the neighbour's cluster is shifted to follow the fluctuation. Only the bookkeeping differs, the clusters are merged by pixel_clusters.link(...) instead of relabelling the grid. As in the original, when a pixel that is not connected to anything is connected to an existing cluster, all the pixels not connected so far are counted as connected (the original relabelled them all with the label of the new cluster, case[case == case[pixel]] = step with case[pixel] = 0), so the ratio reaches 1 and the loop ends, typically after some sqrt(n_sea_pixels) connections. With relabel_free = False only the pixel itself joins the cluster (as the relabelling was meant), the loop then goes on until the `ratio_bound' of the sea pixels are connected through the fluctuations, which changes the field much more (the fluctuations accumulate along the clusters). The default (pa.relabel_free()) is True, i.e. the original behaviour.
 
-            # These outer conditions run through different combinations of randomly selected options: there are four - moving along longitude or latitude and then moving by plus or minus 1. Each case is dealt separately (the comments from the case 1 can be repeated for each other case).
+@mhp.timed('fluctuations_distribute')
+def fluctuations_clusters(field, flux, factor, ratio_bound, mask, seed = None, relabel_free = None):
 
-# Case 1
-                      
-            if first_random > 0.5:
+# Define the extrapolated field and regional parameters.
+
+    (region_height, region_width) = np.shape(field)
+    clusters = pixel_clusters(field)    # This stores the information about the pixels that were connected and about the values redistributed along the connections.
+    n_sea_pixels = sum(np.count_nonzero(field[row:row+1024] != mask) for row in range(0, region_height, 1024)) + 0.0   # This is number of relevant pixels (sea), counted by the blocks of rows (the field can be memory-mapped).
+    generator = np.random.default_rng(seed)
+    relabel_free = pa.relabel_free() if relabel_free is None else relabel_free
+    (field_flat, flux_flat) = (np.ravel(field), np.ravel(flux))
 
-                if (second_random > 0.5) & (pix_lon+1 < region_width):  
+# Whether the two pixels were connected (to each other) before.
 
-                    # If value is at the sea and the two points were not connected before (they either were not connected with anything, or not mutually), please go on
-                
-                    if (field_extrapolated[pix_lat, pix_lon+1] != 0) & ((case[pix_lat, pix_lon] != case[pix_lat, pix_lon+1]) | (case[pix_lat, pix_lon]*case[pix_lat, pix_lon+1] == 0)):
-                   
-                        if field[pix_lat, pix_lon+1] > field[pix_lat, pix_lon]: 
-                 
-                            delta = flux[pix_lat, pix_lon]*factor
+    def joined(pixel, neighbour):
 
-                        else: 
+        root = clusters.find(pixel)[0]
 
-                            delta = - flux[pix_lat, pix_lon]*factor
+        return (root == clusters.find(neighbour)[0]) & (clusters.size.get(root, 1) > 1)
 
+# This is the main loop which runs until the pixels where the fluctuations have been redistributed reach the desired ratio, when compared to all the relevant (sea) pixels. The random numbers are drawn in chunks (the progress, i.e. the ratio reached, is reported after every chunk).
 
-                   # This distributes the fluctuation and records the connection in the ``case'' array.
-                    
+    bound = ratio_bound*n_sea_pixels
+    chunk = 2**16
+    draws = 0
 
-                        if case[pix_lat, pix_lon+1] == 0:
-                        
-                            field_extrapolated[pix_lat, pix_lon+1] = field_extrapolated[pix_lat, pix_lon] + delta
-                        
-                            if case[pix_lat, pix_lon] != 0:
-                       
-                                case[pix_lat, pix_lon+1] = case[pix_lat, pix_lon]
+    while clusters.n_connected < bound:
 
-                            else:
+        randoms = generator.random((chunk, 4))
+        lons = np.round((region_width-1)*randoms[:, 0]).astype(int).tolist()
+        lats = np.round((region_height-1)*randoms[:, 1]).astype(int).tolist()
 
-                                case[pix_lat, pix_lon+1] = step
+        for (lon, lat, first_random, second_random) in zip(lons, lats, randoms[:, 2].tolist(), randoms[:, 3].tolist()):
 
-                                case[pix_lat, pix_lon] = step
-                      
-                        else:
+            if clusters.n_connected >= bound:
+                break
 
-                            diff = field_extrapolated[pix_lat, pix_lon] + delta - field_extrapolated[pix_lat, pix_lon+1]
-                            field_extrapolated[case == case[pix_lat, pix_lon+1]] += diff
-                            case[case == case[pix_lat, pix_lon+1]] = step
-                            case[case == case[pix_lat, pix_lon]] = step 
-                   
-        # The same than in the previous step for different random selections...
+            pixel = lat*region_width + lon
 
-# Case 2
+            if field_flat[pixel] == mask:
+                continue
 
-                if (second_random < 0.5) & (pix_lon-1 >= 0):
-                
-                    if (field_extrapolated[pix_lat, pix_lon-1] != 0) & ((case[pix_lat, pix_lon] != case[pix_lat, pix_lon-1]) | (case[pix_lat, pix_lon]*case[pix_lat, pix_lon-1] == 0)):
-                   
-                        if field[pix_lat, pix_lon-1] > field[pix_lat, pix_lon]: 
-                 
-                            delta = flux[pix_lat, pix_lon]*factor
+# `first random' selects whether we move by 1 in longitudal direction, or latitudal direction, `second random' whether we move by plus or minus one. As in the original, the direction is flipped when the neighbours in it were already connected to the pixel.
 
-                        else: 
+            if (first_random > 0.5) & (lon+1 < region_width) & (lon-1 >= 0):
+                if joined(pixel, pixel+1) & joined(pixel, pixel-1):
+                    first_random = 1.0 - first_random
 
-                            delta = - flux[pix_lat, pix_lon]*factor
+            if (first_random < 0.5) & (lat+1 < region_height) & (lat-1 >= 0):
+                if joined(pixel, pixel+region_width) & joined(pixel, pixel-region_width):
+                    first_random = 1.0 - first_random
 
-                    
-                        if case[pix_lat, pix_lon-1] == 0:
-                        
-                            field_extrapolated[pix_lat, pix_lon-1] = field_extrapolated[pix_lat, pix_lon] + delta
-                        
-                            if case[pix_lat, pix_lon] != 0:
-                       
-                                case[pix_lat, pix_lon-1] = case[pix_lat, pix_lon]
+            if (first_random > 0.5) & (second_random > 0.5) & (lon+1 < region_width):
+                if joined(pixel, pixel+1):
+                    second_random = 1.0 - second_random
 
-                            else:
+            if (first_random > 0.5) & (second_random < 0.5) & (lon-1 >= 0):
+                if joined(pixel, pixel-1):
+                    second_random = 1.0 - second_random
 
-                                case[pix_lat, pix_lon-1] = step
+            if (first_random < 0.5) & (second_random > 0.5) & (lat+1 < region_height):
+                if joined(pixel, pixel+region_width):
+                    second_random = 1.0 - second_random
 
-                                case[pix_lat, pix_lon] = step
-                      
-                        else:
+            if (first_random < 0.5) & (second_random < 0.5) & (lat-1 >= 0):
+                if joined(pixel, pixel-region_width):
+                    second_random = 1.0 - second_random
 
-                            diff = field_extrapolated[pix_lat, pix_lon] + delta - field_extrapolated[pix_lat, pix_lon-1]
-                            field_extrapolated[case == case[pix_lat, pix_lon-1]] += diff
-                            case[case == case[pix_lat, pix_lon-1]] = step
-                            case[case == case[pix_lat, pix_lon]] = step 
-                   
-                    
-# Case 3
+            neighbour = None
 
+            if first_random > 0.5:
+                if (second_random > 0.5) & (lon+1 < region_width):
+                    neighbour = pixel+1
+                elif (second_random < 0.5) & (lon-1 >= 0):
+                    neighbour = pixel-1
+            elif first_random < 0.5:
+                if (second_random > 0.5) & (lat+1 < region_height):
+                    neighbour = pixel+region_width
+                elif (second_random < 0.5) & (lat-1 >= 0):
+                    neighbour = pixel-region_width
 
+# If the neighbour is at the sea and the two points were not connected before, the fluctuation is distributed: the neighbour's cluster is shifted to the pixel's value plus the fluctuation and the clusters are connected.
 
-            if first_random < 0.5:
-              
-                if (second_random > 0.5) & (pix_lat+1 < region_height): 
-                
-                    if (field_extrapolated[pix_lat+1, pix_lon] != 0) & ((case[pix_lat+1, pix_lon] != case[pix_lat, pix_lon]) | (case[pix_lat+1, pix_lon]*case[pix_lat, pix_lon] == 0)):
-                   
-                        if field[pix_lat+1, pix_lon] > field[pix_lat, pix_lon]: 
-                 
-                            delta = flux[pix_lat, pix_lon]*factor
+            if (neighbour is None) or (field_flat[neighbour] == mask) or joined(pixel, neighbour):
+                continue
 
-                        else: 
+            delta = float(flux_flat[pixel])*factor if field_flat[neighbour] > field_flat[pixel] else -float(flux_flat[pixel])*factor
+            relabelled = relabel_free and (clusters.cluster_size(pixel) == 1) & (clusters.cluster_size(neighbour) > 1)
 
-                            delta = - flux[pix_lat, pix_lon]*factor
+            clusters.link(pixel, neighbour, delta)
 
-                    
-                        if case[pix_lat+1, pix_lon] == 0:
-                        
-                            field_extrapolated[pix_lat+1, pix_lon] = field_extrapolated[pix_lat, pix_lon] + delta
-                        
-                            if case[pix_lat, pix_lon] != 0:
-                       
-                                case[pix_lat+1, pix_lon] = case[pix_lat, pix_lon]
+            if relabelled:
+                clusters.n_connected = int(n_sea_pixels)
 
-                            else:
+        draws += chunk
+        mhp.progress('fluctuations_distribute', ratio = clusters.n_connected/max(n_sea_pixels, 1.0), ratio_bound = ratio_bound, draws = draws)
 
-                                case[pix_lat+1, pix_lon] = step
+    return clusters
 
-                                case[pix_lat, pix_lon] = step
-                      
-                        else:
 
-                            diff = field_extrapolated[pix_lat, pix_lon] + delta - field_extrapolated[pix_lat+1, pix_lon]
-                            field_extrapolated[case == case[pix_lat+1, pix_lon]] += diff
-                            case[case == case[pix_lat+1, pix_lon]] = step
-                            case[case == case[pix_lat, pix_lon]] = step 
- 
-# Case 4
-                  
-                   
-                if (second_random < 0.5) & (pix_lat-1 >= 0):
-
-                    if (field_extrapolated[pix_lat-1, pix_lon] != 0) & ((case[pix_lat, pix_lon] != case[pix_lat-1, pix_lon]) | (case[pix_lat-1, pix_lon]*case[pix_lat, pix_lon] == 0)):
-                   
-                        if field[pix_lat-1, pix_lon] > field[pix_lat, pix_lon]: 
-                 
-                            delta = flux[pix_lat, pix_lon]*factor
-
-                        else: 
-
-                            delta = - flux[pix_lat, pix_lon]*factor
-
-                    
-                        if case[pix_lat-1, pix_lon] == 0:
-                        
-                            field_extrapolated[pix_lat-1, pix_lon] = field_extrapolated[pix_lat, pix_lon] + delta
-                        
-                            if case[pix_lat, pix_lon] != 0:
-                       
-                                case[pix_lat-1, pix_lon] = case[pix_lat, pix_lon]
-
-                            else:
-
-                                case[pix_lat-1, pix_lon] = step
-
-                                case[pix_lat, pix_lon] = step
-                      
-                        else:
-
-                            diff = field_extrapolated[pix_lat, pix_lon] + delta - field_extrapolated[pix_lat-1, pix_lon]
-                            field_extrapolated[case == case[pix_lat-1, pix_lon]] += diff
-                            case[case == case[pix_lat-1, pix_lon]] = step
-                            case[case == case[pix_lat, pix_lon]] = step 
-                      
-   # After the step was done we update the ``ratio'' value and increase the ``step'' value.                    
-            
-            
-            nonzero = len(case[np.where(case > 0)])
-            ratio = nonzero/n_sea_pixels
-            step += 1            
-            
-    return field_extrapolated
 
+# The number of the original (coarse) pixels by which the tiles of the tiled extrapolation overlap, so that the smoothen(...) function gives inside the tiles exactly the same values as for the whole region. Each of the 5 smoothening steps spreads the information by the averaging box (`step' pixels) and by the stretching block (`level' - 1 pixels).
+
+def tile_halo(level):
+
+    return int(np.ceil(5*(np.ceil((level-1)/2.0) + level - 1)/(level+0.0)))
+
+
+
+# This prepares a single tile of the tiled extrapolation (it runs in a worker process): the extrapolated fluxes and the smoothened field, the fluctuations are then distributed over the whole assembled grid. The `task' contains: the tile field with the halo, the halo widths (top, bottom, left, right, in the original pixels), the tile fluxes (no halo), n_iterations, the UM parameters, mask, the PDF and the tile random seed. It returns the smoothened tile and the extrapolated tile fluxes.
+
+def extrapolate_tile(task):
+
+    (field, halo, flux, n_iterations, parameters, mask, PDF, seed) = task
+    level = 2**n_iterations
+
+    flux_extrapolated = fluxes_extrapolate(flux, n_iterations, parameters, mask, seed = np.random.default_rng(seed), PDF = PDF)
+    field_smooth = smoothen(upsampled_field(field, level), level, level, 2.0, mask)
+    field_smooth = field_smooth[halo[0]*level : np.shape(field_smooth)[0] - halo[1]*level, halo[2]*level : np.shape(field_smooth)[1] - halo[3]*level]
+
+    return field_smooth, flux_extrapolated
 
 
 
+# This generates one member of the ensemble extrapolation (it runs in a worker process). The deterministic inputs (the smoothened field at the lower scale, the fluxes and the PDF) are read from the shared memory blocks given by their (name, shape) in `task', together with n_iterations, the UM parameters, the fluctuation factor, ratio_bound, relabel_free, mask, the member index and its random seed. Returns the member index and the extrapolated field.
 
+def extrapolate_member(task):
 
+    (shared, n_iterations, parameters, factor, ratio_bound, relabel_free, mask, member, seed) = task
+    blocks = [shared_memory.SharedMemory(name = name) for (name, shape) in shared]
 
+    try:
+        (field_smooth, flux, PDF) = [np.ndarray(shape, dtype=np.float64, buffer=block.buf) for (block, (name, shape)) in zip(blocks, shared)]
+        generator = np.random.default_rng(seed)
+        flux_extrapolated = fluxes_extrapolate(flux, n_iterations, parameters, mask, seed = generator, PDF = PDF)
+        field_extrapolated = fluctuations_distribute(field_smooth, flux_extrapolated, factor, ratio_bound, mask, seed = generator, relabel_free = relabel_free)
+        del field_smooth, flux, PDF
+    finally:
+        for block in blocks:
+            block.close()
 
+    return member, field_extrapolated
@@ -1,14 +1,24 @@
 # Author: Jozef Skakala, PML, 2016 
-# This is the core function for the extrapolation. Plug in field at larger scales ('field') and obtain returned field at lower scales (determined by the iteraion exponent: `n_iterations').  Besides the field distribution input and number of iterations, other optional arguments are 'latitudes', 'momenta_flux', 'momenta_inc', 'max_scale', 'min_scale', 'scale_coeff', 'mask', 'scales_inc' and 'ratio_bound'. If the optional arguments are skipped, the arguments take their default values from the multifractal_parameter_pub module. The 'latitudes' argument is supplied to calculate the physical distance from the longitudal (spherical) coordinate distance. It can be also used to reflect on grid pixels that have unequal length in longitude and latitude directions. The increments scaling calculation can be computationally costly and therefore one can choose optimal range of scales for the analysis through the 'scales_inc' argument. It can be argued that the multiplicative (log-homogeneous) cascade from the default settings (pa.scales(...)) is for the increments scaling analysis far from optimal. One for example might prefer to use homogeneously spread scales with a suitable scaling gap. The additional arguments (as listed before) are separately introduced as optional in both multifractal_extrapolation_pub and multifractal_class_pub, instead of just being passed as the essential arguments to the multifractal_class_pub. The reason for this is that multifractal_class_pub stands as a separate computational tool in the situations when one is interested only in the scaling analysis and not in the field extrapolation.
+# This is the core function for the extrapolation. Plug in field at larger scales ('field') and obtain returned field at lower scales (determined by the iteraion exponent: `n_iterations').  Besides the field distribution input and number of iterations, other optional arguments are 'latitudes', 'momenta_flux', 'momenta_inc', 'max_scale', 'min_scale', 'scale_coeff', 'mask', 'scales_inc', 'ratio_bound', 'relabel_free' (see mef.fluctuations_clusters(...)), 'scaling_method', 'increments_method', 'plan', 'cache' (see multifractal_class_pub) and 'seed' (integer or numpy.random.Generator, making the stochastic extrapolation reproducible). The multifractal analysis can be supplied as 'analysis' (a multifractals instance), then it is not recomputed. Supplying 'n_workers' and / or 'tile_size' switches to the tiled, process-parallel extrapolation (see tiled_extrapolation(...)), in that case the 'seed' should be an integer (or None). Supplying 'output' (a .npy file path) switches to the out-of-core extrapolation (see out_of_core_extrapolation(...)), also when 'n_workers' and / or 'tile_size' are supplied (they then apply to the out-of-core tiles). The 'field' can also be a .npy file path (it is memory-mapped) or a numpy.memmap. The stages of the extrapolation (and their progress) can be followed through the hooks of the multifractal_hooks_pub module, e.g. by its timing_collector. If the optional arguments are skipped, the arguments take their default values from the multifractal_parameter_pub module. The 'latitudes' argument is supplied to calculate the physical distance from the longitudal (spherical) coordinate distance. It can be also used to reflect on grid pixels that have unequal length in longitude and latitude directions. The increments scaling calculation can be computationally costly and therefore one can choose optimal range of scales for the analysis through the 'scales_inc' argument. It can be argued that the multiplicative (log-homogeneous) cascade from the default settings (pa.scales(...)) is for the increments scaling analysis far from optimal. One for example might prefer to use homogeneously spread scales with a suitable scaling gap. The additional arguments (as listed before) are separately introduced as optional in both multifractal_extrapolation_pub and multifractal_class_pub, instead of just being passed as the essential arguments to the multifractal_class_pub. The reason for this is that multifractal_class_pub stands as a separate computational tool in the situations when one is interested only in the scaling analysis and not in the field extrapolation.
 
 import numpy as np
 import multifractal_basic_functions_pub as mbf
 import multifractal_extrapolate_functions_pub as mef
 from multifractal_class_pub import multifractals
 import multifractal_parameter_values_pub as pa
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import os
+import contextlib
+import tempfile
+import multifractal_hooks_pub as mhp
 
+@mhp.timed('field_extrapolation')
 def field_extrapolation(field, n_iterations, **kwargs):
 
+    if isinstance(field, str):
+        field = np.load(field, mmap_mode = 'r')    # a .npy file path is memory-mapped (see out_of_core_extrapolation(...))
+
     if 'latitudes' in kwargs:
         latitudes = kwargs['latitudes']
     else:
@@ -54,17 +64,208 @@ def field_extrapolation(field, n_iterations, **kwargs):
     else:
         ratio_bound = pa.ratio_bound()
 
+    if 'relabel_free' in kwargs:
+        relabel_free = kwargs['relabel_free']
+    else:
+        relabel_free = pa.relabel_free()
+
+    if 'seed' in kwargs:
+        generator = np.random.default_rng(kwargs['seed'])
+    else:
+        generator = np.random.default_rng()
+
+
+    if 'analysis' in kwargs:
+        field_multifractal = kwargs['analysis']
+    else:
+        field_multifractal = multifractals(field, latitudes = latitudes, momenta_flux = momenta_flux, momenta_inc = momenta_inc, max_scale = max_scale, min_scale = min_scale, scale_coeff = scale_coeff, mask = mask, scales_inc = scales_inc, scaling_method = kwargs.get('scaling_method', 'integral'), increments_method = kwargs.get('increments_method', 'circle'), plan = kwargs.get('plan'), cache = kwargs.get('cache', False))    # Calculate the multifractal scaling of the field
 
-    field_multifractal = multifractals(field, latitudes = latitudes, momenta_flux = momenta_flux, momenta_inc = momenta_inc, max_scale = max_scale, min_scale = min_scale, scale_coeff = scale_coeff, mask = mask, scales_inc = scales_inc)    # Calculate the multifractal scaling of the field
     parameters = field_multifractal.UM_parameters()  # Extract the UM parameters
     fluxes = field_multifractal.fluxes()  # Extract the fluxes
     factor = parameters[4]*(1/2.0**n_iterations)**parameters[0]   # the factor that relates fluctuations to fluxes
     
+    if 'output' in kwargs:    # the 'tile_size' and 'n_workers' (if supplied) are passed to the out-of-core extrapolation
+
+        return out_of_core_extrapolation(field, n_iterations, kwargs.pop('output'), **dict(kwargs, analysis = field_multifractal))
+
+    if ('n_workers' in kwargs) | ('tile_size' in kwargs):
 
-    fluxes_extrapolated = mef.fluxes_extrapolate(fluxes, n_iterations, parameters, mask)   # Extrapolate fluxes
+        return tiled_extrapolation(field, fluxes, n_iterations, parameters, factor, ratio_bound, relabel_free, mask, kwargs.get('seed'), kwargs.get('n_workers'), kwargs.get('tile_size', 64))
 
-    field_scaled_down = mef.smoothen(mef.lower_resolution(field, 2**n_iterations), 2**n_iterations, 2**n_iterations, 2.0, mask)  # Get the smoothen version of the field on the lower scale
+    fluxes_extrapolated = mef.fluxes_extrapolate(fluxes, n_iterations, parameters, mask, seed = generator)   # Extrapolate fluxes
 
-    field_extrapolated = mef.fluctuations_distribute(field_scaled_down, fluxes_extrapolated, factor, ratio_bound, mask)  # Distribute the field fluctuations on the lower scale using the 1. fluxes and 2. smoothened field .
+    field_scaled_down = mef.smoothen(mef.upsampled_field(field, 2**n_iterations), 2**n_iterations, 2**n_iterations, 2.0, mask)  # Get the smoothen version of the field on the lower scale
+
+    field_extrapolated = mef.fluctuations_distribute(field_scaled_down, fluxes_extrapolated, factor, ratio_bound, mask, seed = generator, relabel_free = relabel_free)  # Distribute the field fluctuations on the lower scale using the 1. fluxes and 2. smoothened field .
 
     return field_extrapolated
+
+
+
+# The task of mef.extrapolate_tile(...) for the tile with the upper left `corner' (in the original pixels): the tile field with the halo (cut by the region borders) and the tile fluxes. The field can be memory-mapped, only the tile is read.
+
+def tile_task(field, fluxes, corner, stream, tile_size, halo, n_iterations, parameters, mask, PDF):
+
+    (lat, lon) = corner
+    (region_height, region_width) = np.shape(field)
+    lat_2 = min(lat + tile_size, region_height)
+    lon_2 = min(lon + tile_size, region_width)
+    tile_halo = (lat - max(lat - halo, 0), min(lat_2 + halo, region_height) - lat_2, lon - max(lon - halo, 0), min(lon_2 + halo, region_width) - lon_2)
+    tile_field = np.array(field[lat - tile_halo[0] : lat_2 + tile_halo[1], lon - tile_halo[2] : lon_2 + tile_halo[3]], dtype=float)
+
+    return (tile_field, tile_halo, fluxes[lat:lat_2, lon:lon_2], n_iterations, parameters, mask, PDF, stream)
+
+
+
+# The tiled (process-parallel) version of the extrapolation. The field is split into tiles of `tile_size' x `tile_size' (original) pixels, the fluxes of each tile are extrapolated and the tile is smoothened by mef.extrapolate_tile(...) in a separate worker process (`n_workers' of them, by default one per CPU). The tiles are smoothened with a halo (mef.tile_halo(...)), so the assembled smoothened field is the same as that of the whole region, and every tile has its own random stream spawned from the `seed', so the result does not depend on the number of workers. The fluctuations are then distributed over the whole assembled grid (mef.fluctuations_distribute(...), with the last stream), as in field_extrapolation(...): the random process connects the pixels across the whole grid, so the tile borders are not seen in the result (distributing the fluctuations tile by tile and shifting the tile clusters to match along the borders leaves jumps several times larger than those within the tiles). With the default (original) relabelling the process connects only some sqrt(N) of the N pixels, so this step is cheap.
+
+@mhp.timed('tiled_extrapolation')
+def tiled_extrapolation(field, fluxes, n_iterations, parameters, factor, ratio_bound, relabel_free, mask, seed, n_workers, tile_size):
+
+    level = 2**n_iterations
+    halo = mef.tile_halo(level)
+    (region_height, region_width) = np.shape(field)
+    PDF = mbf.inverse_mellin_UM(parameters, parameters[3]*level)   # The PDF is common to all the tiles.
+
+    corners = [(lat, lon) for lat in range(0, region_height, tile_size) for lon in range(0, region_width, tile_size)]
+    streams = np.random.SeedSequence(seed).spawn(len(corners) + 1)
+
+    tasks = [tile_task(field, fluxes, corner, stream, tile_size, halo, n_iterations, parameters, mask, PDF) for (corner, stream) in zip(corners, streams)]
+    field_smooth = np.zeros((region_height*level, region_width*level))
+    fluxes_extrapolated = np.zeros((region_height*level, region_width*level))
+
+# The tiles are assembled as they come from the workers.
+
+    with (ProcessPoolExecutor(max_workers = n_workers) if n_workers != 1 else contextlib.nullcontext()) as executor:
+
+        results = map(mef.extrapolate_tile, tasks) if executor is None else executor.map(mef.extrapolate_tile, tasks)
+
+        for (tile, (lat, lon), (tile_smooth, tile_fluxes)) in zip(range(0, len(corners)), corners, results):
+
+            window = (slice(lat*level, lat*level + np.shape(tile_smooth)[0]), slice(lon*level, lon*level + np.shape(tile_smooth)[1]))
+            field_smooth[window] = tile_smooth
+            fluxes_extrapolated[window] = tile_fluxes
+            mhp.progress('tiled_extrapolation', tiles_done = tile + 1, n_tiles = len(corners))
+
+    return mef.fluctuations_distribute(field_smooth, fluxes_extrapolated, factor, ratio_bound, mask, seed = np.random.default_rng(streams[-1]), relabel_free = relabel_free)
+
+
+
+
+# The out-of-core version of the tiled extrapolation, for the extrapolated fields that do not fit into the memory. The `field' can be a .npy file path (it is then memory-mapped) or an array (or numpy.memmap), only the multifractal analysis reads the whole (original resolution) field. The smoothened field is written tile by tile into the preallocated memory-mapped .npy file `output' (and the extrapolated fluxes into a temporary memory-mapped file next to it), the fluctuations are then distributed over the whole grid reading only the pixels they connect (see mef.pixel_clusters) and their shifts are added to the `output' in place, which is returned (as numpy.memmap). The peak memory is bounded by the 'tile_budget' (in bytes, default pa.tile_budget()) per worker: a tile of the extrapolated grid costs about 256 bytes per pixel (the smoothening with the halo and the extrapolation of the fluxes). The fluctuations take about some hundreds of bytes per connected pixel, i.e. little with the default (original) relabelling, which connects some sqrt(N) of the N pixels, but the whole grid with relabel_free = False. Alternatively, the 'tile_size' can be set directly. The tiles are processed `n_workers' at a time (default 1). The other optional arguments are as in field_extrapolation(...), the 'seed' should be an integer (or None). For the same 'tile_size' and 'seed' the result is the same as that of tiled_extrapolation(...).
+
+@mhp.timed('out_of_core_extrapolation')
+def out_of_core_extrapolation(field, n_iterations, output, **kwargs):
+
+    if isinstance(field, str):
+        field = np.load(field, mmap_mode = 'r')
+
+    mask = kwargs.get('mask', pa.masking_value())
+    ratio_bound = kwargs.get('ratio_bound', pa.ratio_bound())
+    relabel_free = kwargs.get('relabel_free', pa.relabel_free())
+    n_workers = kwargs.get('n_workers', 1) or os.cpu_count()
+    level = 2**n_iterations
+    halo = mef.tile_halo(level)
+
+    if 'analysis' in kwargs:
+        field_multifractal = kwargs['analysis']
+    else:
+        field_multifractal = multifractals(np.asarray(field), **dict((key, kwargs[key]) for key in ('latitudes', 'momenta_flux', 'momenta_inc', 'max_scale', 'min_scale', 'scale_coeff', 'mask', 'scales_inc', 'scaling_method', 'increments_method', 'plan', 'cache') if key in kwargs))
+
+    parameters = field_multifractal.UM_parameters()
+    fluxes = field_multifractal.fluxes()
+    factor = parameters[4]*(1/2.0**n_iterations)**parameters[0]
+    PDF = mbf.inverse_mellin_UM(parameters, parameters[3]*level)
+
+    if 'tile_size' in kwargs:
+        tile_size = kwargs['tile_size']
+    else:
+        tile_size = max(int(np.sqrt(kwargs.get('tile_budget', pa.tile_budget())/256.0))//level - 2*halo, 1)
+
+    (region_height, region_width) = np.shape(field)
+    shape = (region_height*level, region_width*level)
+    corners = [(lat, lon) for lat in range(0, region_height, tile_size) for lon in range(0, region_width, tile_size)]
+    streams = np.random.SeedSequence(kwargs.get('seed')).spawn(len(corners) + 1)
+
+    field_extrapolated = np.lib.format.open_memmap(output, mode = 'w+', dtype = np.float64, shape = shape)
+
+    with tempfile.TemporaryDirectory(dir = os.path.dirname(os.path.abspath(output))) as scratch:
+
+        fluxes_extrapolated = np.lib.format.open_memmap(os.path.join(scratch, 'fluxes.npy'), mode = 'w+', dtype = np.float64, shape = shape)
+
+# The tiles are prepared `n_workers' at a time and written out, so only so many tiles are held in the memory.
+
+        with (ProcessPoolExecutor(max_workers = n_workers) if n_workers != 1 else contextlib.nullcontext()) as executor:
+
+            for batch in range(0, len(corners), n_workers):
+
+                tasks = [tile_task(field, fluxes, corners[tile], streams[tile], tile_size, halo, n_iterations, parameters, mask, PDF) for tile in range(batch, min(batch + n_workers, len(corners)))]
+                results = map(mef.extrapolate_tile, tasks) if executor is None else executor.map(mef.extrapolate_tile, tasks)
+
+                for (tile, (tile_smooth, tile_fluxes)) in zip(range(batch, len(corners)), results):
+
+                    (lat, lon) = corners[tile]
+                    window = (slice(lat*level, lat*level + np.shape(tile_smooth)[0]), slice(lon*level, lon*level + np.shape(tile_smooth)[1]))
+                    field_extrapolated[window] = tile_smooth
+                    fluxes_extrapolated[window] = tile_fluxes
+                    mhp.progress('out_of_core_extrapolation', tiles_done = tile + 1, n_tiles = len(corners))
+
+                del tasks, results
+
+# The fluctuations are distributed over the whole grid (as in tiled_extrapolation(...)), the shifts of the connected pixels are added in place.
+
+        clusters = mef.fluctuations_clusters(field_extrapolated, fluxes_extrapolated, factor, ratio_bound, mask, np.random.default_rng(streams[-1]), relabel_free)
+        clusters.apply(field_extrapolated)
+        field_extrapolated.flush()
+        del clusters, fluxes_extrapolated
+
+    return field_extrapolated
+
+
+
+
+# This generates an ensemble of `n_members' stochastic realizations of the extrapolated field. The deterministic parts (the multifractal analysis, the PDF from the inverse Mellin transform and the smoothened field) are computed only once and are placed in the shared memory, the workers (`n_workers' processes, by default one per CPU) then only redistribute the fluxes and the fluctuations. The optional arguments are the same as in field_extrapolation(...) ('seed' should be an integer or None, every member gets its own random stream spawned from it, so the members do not depend on the number of workers). The function is a generator: it yields the (member index, extrapolated field) pairs in the order in which the members are finished.
+
+def ensemble_extrapolation(field, n_iterations, n_members, **kwargs):
+
+    mask = kwargs.get('mask', pa.masking_value())
+    ratio_bound = kwargs.get('ratio_bound', pa.ratio_bound())
+    relabel_free = kwargs.get('relabel_free', pa.relabel_free())
+    level = 2**n_iterations
+
+    if 'analysis' in kwargs:
+        field_multifractal = kwargs['analysis']
+    else:
+        field_multifractal = multifractals(field, **dict((key, kwargs[key]) for key in ('latitudes', 'momenta_flux', 'momenta_inc', 'max_scale', 'min_scale', 'scale_coeff', 'mask', 'scales_inc', 'scaling_method', 'increments_method', 'plan', 'cache') if key in kwargs))
+
+    parameters = field_multifractal.UM_parameters()
+    factor = parameters[4]*(1/2.0**n_iterations)**parameters[0]
+    deterministic = (mef.smoothen(mef.upsampled_field(field, level), level, level, 2.0, mask), np.asarray(field_multifractal.fluxes(), dtype=np.float64), mbf.inverse_mellin_UM(parameters, parameters[3]*level))
+
+# The deterministic parts are copied into the shared memory blocks, the workers attach to them by name.
+
+    blocks = []
+
+    try:
+        for array in deterministic:
+            block = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+            np.ndarray(np.shape(array), dtype=np.float64, buffer=block.buf)[...] = array
+            blocks.append(block)
+
+        shared = [(block.name, np.shape(array)) for (block, array) in zip(blocks, deterministic)]
+        del deterministic
+        streams = np.random.SeedSequence(kwargs.get('seed')).spawn(n_members)
+        tasks = [(shared, n_iterations, parameters, factor, ratio_bound, relabel_free, mask, member, streams[member]) for member in range(0, n_members)]
+
+        if kwargs.get('n_workers') == 1:
+            for task in tasks:
+                yield mef.extrapolate_member(task)
+        else:
+            with ProcessPoolExecutor(max_workers = kwargs.get('n_workers')) as executor:
+                for member in as_completed([executor.submit(mef.extrapolate_member, task) for task in tasks]):
+                    yield member.result()
+
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
@@ -0,0 +1,152 @@
+
+# This module provides the instrumentation of the analysis and of the extrapolation. The stages of the computation (e.g. 'scaling_increments', 'smoothen', 'fluctuations_distribute') report their start and end (with the elapsed time) and their progress (e.g. the scales processed, the ratio of the connected pixels) to the registered hooks. A hook is any callable hook(event, stage, info), where `event' is 'start', 'progress' or 'end' and `info' is a dictionary (e.g. the array shape, the iteration counts, at the 'end' the 'elapsed' wall time in seconds). When no hook is registered, the instrumentation only checks an empty list. The hooks are per process, the stages run by the worker processes (tiled and ensemble extrapolation) are not reported. The timing_collector class is a built-in hook that collects the per-stage timing report, e.g.:
+
+#   with timing_collector() as timings:
+#       field_extrapolation(field, 3)
+#   print(timings.report())
+
+
+
+import time
+import functools
+
+hooks = []
+
+
+
+def add_hook(hook):
+
+    hooks.append(hook)
+
+    return hook
+
+
+
+def remove_hook(hook):
+
+    if hook in hooks:
+        hooks.remove(hook)
+
+
+
+# Sends the event to all the hooks.
+
+def emit(event, stage, **info):
+
+    if hooks:
+        for hook in list(hooks):
+            hook(event, stage, info)
+
+
+
+def progress(stage, **info):
+
+    if hooks:
+        emit('progress', stage, **info)
+
+
+
+# The context manager of a stage: it emits the 'start' event when entered and the 'end' event (with the elapsed time and the `info' updated inside the stage) when left.
+
+class stage:
+
+    def __init__(self, name, **info):
+
+        self.name = name
+        self.info = info
+
+    def __enter__(self):
+
+        if hooks:
+            emit('start', self.name, **self.info)
+            self.start = time.perf_counter()
+
+        return self.info
+
+    def __exit__(self, error_type, error, traceback):
+
+        if hooks and hasattr(self, 'start'):
+            emit('end', self.name, elapsed = time.perf_counter() - self.start, failed = error_type is not None, **self.info)
+
+        return False
+
+
+
+# The decorator making the whole function a stage (the 'shape' of its first argument, if it has one, goes to the info). Without hooks it only adds a check of the empty list to the call.
+
+def timed(name):
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def instrumented(*arguments, **kwargs):
+
+            if not hooks:
+                return function(*arguments, **kwargs)
+
+            info = {}
+            if arguments and hasattr(arguments[0], 'shape'):
+                info['shape'] = tuple(arguments[0].shape)
+
+            with stage(name, **info):
+                return function(*arguments, **kwargs)
+
+        return instrumented
+
+    return decorator
+
+
+
+# The built-in hook collecting the number of calls and the total, minimal and maximal wall time of every stage (and the last progress info). Used as a context manager it registers itself while the block runs. With verbose = True it also prints the events as they come (e.g. to follow a long extrapolation).
+
+class timing_collector:
+
+    def __init__(self, verbose = False):
+
+        self.verbose = verbose
+        self.timings = {}
+        self.last_progress = {}
+        self.order = []
+
+    def __call__(self, event, stage, info):
+
+        if event == 'end':
+            if stage not in self.timings:
+                self.timings[stage] = {'calls': 0, 'total': 0.0, 'min': float('inf'), 'max': 0.0}
+                self.order.append(stage)
+            timing = self.timings[stage]
+            timing['calls'] += 1
+            timing['total'] += info['elapsed']
+            timing['min'] = min(timing['min'], info['elapsed'])
+            timing['max'] = max(timing['max'], info['elapsed'])
+        elif event == 'progress':
+            self.last_progress[stage] = info
+
+        if self.verbose:
+            print('%-10s %-26s %s' % (event, stage, ', '.join('%s = %s' % item for item in sorted(info.items()))))
+
+    def __enter__(self):
+
+        return add_hook(self)
+
+    def __exit__(self, error_type, error, traceback):
+
+        remove_hook(self)
+
+        return False
+
+# The collected timings (as a dictionary stage -> timing) and the printable report (stages in the order they were first finished).
+
+    def results(self):
+
+        return dict((stage, dict(self.timings[stage])) for stage in self.order)
+
+    def report(self):
+
+        lines = ['%-26s %6s %12s %12s %12s' % ('stage', 'calls', 'total [s]', 'min [s]', 'max [s]')]
+
+        for stage in self.order:
+            timing = self.timings[stage]
+            lines.append('%-26s %6d %12.4f %12.4f %12.4f' % (stage, timing['calls'], timing['total'], timing['min'], timing['max']))
+
+        return '\n'.join(lines)
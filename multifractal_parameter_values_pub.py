@@ -4,6 +4,7 @@
 
 
 import numpy as np
+import os
 
 
 def inc_momenta():
@@ -21,12 +22,36 @@ def min_scale():
 def scale_coeff():
     return 1.1
 
+def DTM_momenta():
+    return np.array([1.5, 2.0])
+
+def DTM_etas():
+    return np.logspace(-1.0, 0.4, 15)
+
 def ratio_bound():
     return 0.99
 
+def relabel_free():
+    return True
+
 def PDF_argument():
     return np.linspace(0.0001,140,num=100000)    
 
+def PDF_argument_log():
+    return np.logspace(np.log10(0.0001),np.log10(140),num=4000)
+
+def tile_budget():
+    return 2**28
+
+def cache_directory():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'multifractals')
+
+def cache_size():
+    return 2**30
+
+def plan_cache_size():
+    return 2**24
+
 def masking_value():
     return 0
 
@@ -0,0 +1,174 @@
+
+# This module provides the geometry plan of the multifractal analysis. The analysis functions of the multifractal_scaling_essential_pub module (fluxes, scaling, scaling_increments, scaling_haar) depend on the geometry of the grid (the shape, the latitudes and the land mask pattern) through the geometric factor of the mean sea latitude, the cosines of the latitudes, the ring and circle stencils and the longitudal pixel shifts of the circle offsets. The plan computes all of these once (the stencils lazily, when a scale is first needed) and keeps them, so the analysis of many fields on the same grid (e.g. the daily fields of the same region, or the repeated analysis within the extrapolation) does not recompute them. The plans are kept in an in-process LRU cache addressed by the hash of the geometry (get_plan(...) returns the cached plan or builds a new one, the total size of the kept plans is bounded by pa.plan_cache_size() bytes, also as the kept plans grow), all the analysis functions take the plan as the optional `plan' argument and get it from the cache when it is not supplied. The momenta do not change the geometry, so they are not a part of the plan. The plan keeps only the geometry, not the arrays of the size of the field (e.g. the sea pixel tables), those are cheap to recompute from the field: the latitudes (and the longitudal shifts) are kept per row when they do not change along the rows (as on the regular latitude-longitude grids), the full latitude grid is only kept when they do and the longitudal shifts of the size of the field are not kept at all. The stencil builders (ring_offsets(...), circle_offsets(...)) are defined here and imported by the multifractal_scaling_essential_pub module, so this module does not depend on it.
+
+
+
+import collections
+import numpy as np
+import multifractal_parameter_values_pub as pa
+import multifractal_cache_pub as mcp
+
+plans = collections.OrderedDict()
+
+
+
+class plan:
+
+    def __init__(self, shape, latitudes, sea, scales_inc = ()):
+
+        self.shape = tuple(shape)
+        theta = np.mean(np.broadcast_to(latitudes, self.shape)[np.broadcast_to(sea, self.shape)])
+        self.geometric_factor = np.cos(np.pi*theta/180.0)
+        self.cos_latitudes = np.cos(np.pi*compact_latitudes(latitudes)/180.0)
+
+        self.rings = {}
+        self.circles = {}
+        self.shifts_long = {}
+
+        for length in scales_inc:    # the circle stencils of the known scales are computed at once
+            self.circle(length)
+
+# The ring offsets of the step size (see ring_offsets(...)).
+
+    def ring(self, step_size):
+
+        if step_size not in self.rings:
+            self.rings[step_size] = ring_offsets(step_size, self.geometric_factor)
+            trim_plans()
+
+        return self.rings[step_size]
+
+# The circle offsets of the length (see circle_offsets(...)).
+
+    def circle(self, length):
+
+        if length not in self.circles:
+            self.circles[length] = circle_offsets(length)
+            trim_plans()
+
+        return self.circles[length]
+
+# The longitudal shifts (in pixels, broadcastable to the grid) of the circle offset n_x and their distinct values. The shift is rounded as the original pixel loop did it, i.e. the summed coordinate pixel_long + n_x/cos(latitude) is truncated (flooring the offset alone differs from it where the sum is rounded up to an integer, e.g. at 60 degrees), so it may depend on the column. The shifts are kept per row (or as a single number) when they do not depend on the column, the shifts of the size of the field (e.g. of the curvilinear grids) are not kept but recomputed for every call.
+
+    def shift_long(self, n_x):
+
+        if n_x in self.shifts_long:
+            return self.shifts_long[n_x]
+
+        columns = np.arange(self.shape[1])
+        shift = np.floor(columns + n_x/self.cos_latitudes).astype(int) - columns
+        if np.all(shift == shift[..., :1]):
+            shift = shift[..., :1]
+        shifts = (shift, np.unique(shift))
+
+        if np.shape(shift)[-1] == 1:
+            self.shifts_long[n_x] = shifts
+            trim_plans()
+
+        return shifts
+
+# The memory held by the plan (in bytes, approximately: the arrays and the stencil offsets).
+
+    def nbytes(self):
+
+        n_offsets = sum(len(offsets) for offsets in self.rings.values()) + sum(len(offsets) for offsets in self.circles.values())
+
+        return np.size(self.cos_latitudes)*8 + sum(shift.nbytes + values.nbytes for (shift, values) in self.shifts_long.values()) + 64*n_offsets
+
+
+
+# The ring (stencil) of relative pixel offsets (d_lat, d_lon) that lie at the distance `step_size' from the centre pixel, the distance being corrected by the `geometric_factor'. The ring depends only on these two values, so it is computed once and then reused for every pixel of the field.
+
+def ring_offsets(step_size, geometric_factor):
+
+    offsets = []
+    radius_lat = int(round(step_size))
+    radius_lon = int(round(step_size/geometric_factor))
+
+    for d_lat in range(-radius_lat, radius_lat+1):
+        for d_lon in range(-radius_lon, radius_lon+1):
+
+            if round(np.sqrt((d_lon*geometric_factor)**2+d_lat**2)) == round(step_size):
+                offsets.append((d_lat, d_lon))
+
+    return offsets
+
+
+
+# The circle offsets (n_x, n_y) with radius = `length', as they are walked by the scaling_increments(...) function, together with their multiplicity (the points with n_y = 0 are reached from both signs and count twice). The n_x offset is still in the longitudal `degrees', it is converted to pixels using the latitude of the centre pixel.
+
+def circle_offsets(length):
+
+    offsets = {}
+
+    for n_x in range(int(-length),int(length)+1):
+        for sign in range(-1,2,2):
+
+            n_y = int(sign*np.round(np.sqrt(length**2-n_x**2)))
+            offsets[(n_x, n_y)] = offsets.get((n_x, n_y), 0) + 1
+
+    return offsets
+
+
+
+# The latitudes in the smallest form that broadcasts to the grid: a number for the constant latitudes, a column (lat, 1) when they do not change along the rows, otherwise the full grid.
+
+def compact_latitudes(latitudes):
+
+    latitudes = np.asarray(latitudes, dtype=float)
+
+    if np.all(latitudes == latitudes.flat[0]):
+        return np.array(latitudes.flat[0])
+    if (np.ndim(latitudes) == 2) and np.all(latitudes == latitudes[:, :1]):
+        return latitudes[:, :1]
+
+    return latitudes
+
+
+
+# The hash of the geometry: the shape, the latitudes and the land mask pattern of the field (a single field or a stack).
+
+def geometry_key(field, latitudes, mask):
+
+    return mcp.cache_key(np.shape(field), np.broadcast_to(latitudes, np.shape(field)[-2:]), np.packbits(np.asarray(field) != mask))
+
+
+
+# Returns the plan of the geometry of the field from the LRU cache, or builds (and caches) a new one. The `scales_inc' are the scales of the circle stencils computed in advance.
+
+def get_plan(field, latitudes, mask, scales_inc = ()):
+
+    key = geometry_key(field, latitudes, mask)
+
+    if key in plans:
+        plans.move_to_end(key)
+        geometry = plans[key]
+        for length in scales_inc:
+            geometry.circle(length)
+        return geometry
+
+    geometry = plan(np.shape(field), latitudes, np.asarray(field) != mask, scales_inc)
+    plans[key] = geometry
+    trim_plans()
+
+    return geometry
+
+
+
+# Evicts the least recently used plans until the total size of the cached plans is within pa.plan_cache_size() bytes. It is called whenever a plan is cached and whenever a cached plan grows (by a new stencil or shift), a plan larger than the bound alone is not kept either (its users keep their reference).
+
+def trim_plans():
+
+    total = sum(cached.nbytes() for cached in plans.values())
+
+    while plans and (total > pa.plan_cache_size()):
+        (key, evicted) = plans.popitem(last = False)
+        total -= evicted.nbytes()
+
+
+
+# Removes all the cached plans.
+
+def clear_plans():
+
+    plans.clear()
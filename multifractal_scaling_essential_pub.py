@@ -5,44 +5,53 @@
 
 import numpy as np
 import multifractal_basic_functions_pub as mbf
+from scipy.optimize import minimize
 from multifractal_parameter_values_pub import masking_value
+import multifractal_hooks_pub as mhp
+import multifractal_plan_pub as mpl
+from multifractal_plan_pub import ring_offsets, circle_offsets    # the stencil builders live with the plan that caches them
 
 
 
-# This function computes the fluxes for a specific distribution given by the `field' variable. The function computes the fluxes at the scale given by the `step_size' variable. The fluxes are computed by a simple method of taking `delta field / mean(delta field)' and averaging this quantity through a circle originating at the point of the flux value. The details of this computation are just a special case of the function scaling_increments(...). The last two variables are latitudes and mask, counting for geometric corrections (geometric distance - see comments in multifractal_class_pub) and a value that indicates mask.
+# For a relative offset (d_lat, d_lon) this returns the pair of indices (centre, neighbour) such that field[centre] and field[neighbour] are the whole-array overlaps of the field with its shifted copy. It is the basic building block of the stencil computations. The offset applies to the last two axes, so the same indices serve a stack of fields (time, lat, lon). Offsets larger than the region give empty overlaps.
 
-def fluxes(field, step_size, latitudes, mask):
+def shifted_slices(d_lat, d_lon, shape):
 
-    
-    theta = np.mean(latitudes[field != mask])
-    geometric_factor = np.cos(np.pi*theta/180.0)
+    (region_height, region_width) = shape[-2:]
 
-    (region_height, region_width) = np.shape(field)
-    flux = np.ones((region_height, region_width))*mask
-    
-    for lon in range(0, region_width):
-        for lat in range(0, region_height):
+    centre = (Ellipsis, slice(max(0, -d_lat), max(0, min(region_height, region_height - d_lat))), slice(max(0, -d_lon), max(0, min(region_width, region_width - d_lon))))
+    neighbour = (Ellipsis, slice(max(0, d_lat), max(0, min(region_height, region_height + d_lat))), slice(max(0, d_lon), max(0, min(region_width, region_width + d_lon))))
 
-            if field[lat,lon] != mask:
+    return centre, neighbour
 
-                rel_case = 0
 
-                for sublat in np.arange(max(lat-round(step_size),0), min(region_height, lat+round(step_size)+1)):
-                    for sublon in np.arange(max(lon-round(step_size/geometric_factor),0), min(region_width, lon+round(step_size/geometric_factor)+1)):
 
-                        if (round(np.sqrt(((sublon-lon)*geometric_factor)**2+(sublat-lat)**2)) == round(step_size)) & (field[sublat, sublon] != mask):
- 
-                            flux[lat,lon] += np.abs(field[sublat,sublon] - field[lat,lon]) 
-                            rel_case += 1
-                                                       
-                        
-              
-                if rel_case >= 1: 
+# This function computes the fluxes for a specific distribution given by the `field' variable. The function computes the fluxes at the scale given by the `step_size' variable. The fluxes are computed by a simple method of taking `delta field / mean(delta field)' and averaging this quantity through a circle originating at the point of the flux value. The details of this computation are just a special case of the function scaling_increments(...). The last two variables are latitudes and mask, counting for geometric corrections (geometric distance - see comments in multifractal_class_pub) and a value that indicates mask. The circle is evaluated as a stencil: for every ring offset the absolute differences between the field and its shifted copy are accumulated over the whole array at once. The `field' can also be a stack of fields on the same grid (time, lat, lon), then the fluxes of all the fields are computed together (and each is normalized by its own mean). The geometry (the ring) comes from the `plan' (see multifractal_plan_pub), by default the cached plan of the field geometry.
+
+@mhp.timed('fluxes')
+def fluxes(field, step_size, latitudes, mask, plan = None):
+
+    plan = mpl.get_plan(field, latitudes, mask) if plan is None else plan
+    sea = field != mask
 
-                    flux[lat, lon] = (flux[lat, lon] - mask)/(rel_case + 0.0)
+    delta_sum = np.zeros(np.shape(field))
+    rel_case = np.zeros(np.shape(field))
 
+    for (d_lat, d_lon) in plan.ring(step_size):
 
-    flux[flux != mask] = flux[flux != mask] / np.mean(flux[flux != mask])
+        (centre, neighbour) = shifted_slices(d_lat, d_lon, np.shape(field))
+        valid = sea[centre] & sea[neighbour]
+        delta_sum[centre] += np.where(valid, np.abs(field[neighbour] - field[centre]), 0.0)
+        rel_case[centre] += valid
+
+    flux = np.ones(np.shape(field))*mask
+    flux[sea] += delta_sum[sea]
+    connected = sea & (rel_case >= 1)
+    flux[connected] = delta_sum[connected]/rel_case[connected]
+
+    relevant = flux != mask
+    flux_mean = np.sum(np.where(relevant, flux, 0.0), axis=(-2, -1), keepdims=True)/np.count_nonzero(relevant, axis=(-2, -1), keepdims=True)
+    flux = np.where(relevant, flux/flux_mean, flux)
                     
     return flux
 
@@ -51,33 +60,181 @@ def fluxes(field, step_size, latitudes, mask):
 
 
 
+# The integral images (summed-area tables) of the field: the sum of the non-masked field values, the number of non-masked pixels and the sum of the squared deviations from the `shift' value (subtracting the shift keeps the variances numerically accurate). Each table has one extra leading row and column of zeros, so that table[i, j] is the sum over field[:i, :j]. For a stack of fields (time, lat, lon) the tables are stacked as well, the `shift' then has the shape (time, 1, 1).
+
+def integral_images(field, mask, shift):
+
+    sea = field != mask
+    values = np.where(sea, field, 0.0)
+    squares = np.where(sea, (field - shift)**2, 0.0)
+    tables = np.zeros((3,) + np.shape(field)[:-2] + (np.shape(field)[-2]+1, np.shape(field)[-1]+1))
+
+    for (table, layer) in zip(tables, (values, sea, squares)):
+        table[..., 1:, 1:] = np.cumsum(np.cumsum(layer, axis=-2), axis=-1)
+
+    return tables
+
+
+
+# This returns the box sums of the integral image `table' for all the boxes given by the edges (lat_1, lat_2) x (long_1, long_2), with lat_1, lat_2 being arrays of box edges in the latitudal direction and long_1, long_2 in the longitudal direction. The output is a (n_boxes_lat, n_boxes_long) array (with the leading time axis for stacked tables).
+
+def box_sums(table, lat_1, lat_2, long_1, long_2):
+
+    lat_1 = lat_1[:, np.newaxis]
+    lat_2 = lat_2[:, np.newaxis]
+
+    return table[..., lat_2, long_2] - table[..., lat_1, long_2] - table[..., lat_2, long_1] + table[..., lat_1, long_1]
+
+
+
+# This evaluates one scale of the scaling(...) function from the integral images: the boxes of the size n_box_pixels_lat x n_box_pixels_long are laid from all 4 regional corners and the desired output (moment, variance, st_deviation) is summed with the same statistical weights as in the box-by-box evaluation. For stacked tables the output has the leading time axis.
+
+def box_moments_integral(tables, momenta, n_box_pixels_lat, n_box_pixels_long, output, mean_field_region, total_n_pixels_sea, non_negative = False):
+
+    stack = np.shape(tables)[1:-2]    # the leading (time) axes of stacked tables
+    region_height = np.shape(tables)[-2] - 1
+    region_width = np.shape(tables)[-1] - 1
+    n_box_pixels_lat = int(n_box_pixels_lat)
+    n_box_pixels_long = int(n_box_pixels_long)
+    boxes_lat = np.arange(1, int(mbf.round_up(region_height/(n_box_pixels_lat+0.0)))+1)
+    boxes_long = np.arange(1, int(mbf.round_up(region_width/(n_box_pixels_long+0.0)))+1)
+    mean_field_region = np.reshape(mean_field_region, stack + (1,))
+    total_n_pixels_sea = np.reshape(total_n_pixels_sea, stack + (1,))
+
+# The box edges when the boxes originate from the top / left corners and from the bottom / right corners.
+
+    edges_lat = [((boxes_lat-1)*n_box_pixels_lat, np.minimum(boxes_lat*n_box_pixels_lat, region_height)), (np.maximum(region_height - boxes_lat*n_box_pixels_lat, 0), region_height - (boxes_lat-1)*n_box_pixels_lat)]
+    edges_long = [((boxes_long-1)*n_box_pixels_long, np.minimum(boxes_long*n_box_pixels_long, region_width)), (np.maximum(region_width - boxes_long*n_box_pixels_long, 0), region_width - (boxes_long-1)*n_box_pixels_long)]
+
+    het = np.zeros(stack + (len(momenta),))
+
+    for (lat_1, lat_2) in edges_lat:
+        for (long_1, long_2) in edges_long:
+
+            layers = [np.reshape(box_sums(table, lat_1, lat_2, long_1, long_2), stack + (-1,)) for table in (tables if output != 'moment' else tables[:2])] + [None]
+            het += box_statistics(layers, momenta, output, mean_field_region, total_n_pixels_sea, non_negative)
+
+    return het
+
+
+
+# The contribution of one box layout (from one of the 4 corners) to the output of the scaling(...) function. The `layers' are the box sums of the sea values, the numbers of the sea pixels and the sums of the squares (shifted by the regional mean, they are not needed for output = 'moment'), each of the shape (..., boxes). The mean_field_region and total_n_pixels_sea have the shape (..., 1). With non_negative = True the box sums are clipped at 0 for output = 'moment', for the fields known to be non-negative, whose box sums of the integral images can still cancel slightly below zero (see scaling(...)).
+
+def box_statistics(layers, momenta, output, mean_field_region, total_n_pixels_sea, non_negative = False):
+
+    (sums, sea_n_box_pixels, squares) = layers[:3]
+    sea_n_box_pixels = np.round(sea_n_box_pixels)
+    box_importance = sea_n_box_pixels/(4*total_n_pixels_sea)
+
+# The boxes that are not relevant (no sea, or a single sea pixel for the variance) get zero weight.
+
+    if output == 'moment':
+
+        relevant = sea_n_box_pixels > 0
+        sums = np.maximum(sums, 0.0) if non_negative else sums
+        mean_box = np.where(relevant, sums, mean_field_region)/np.maximum(sea_n_box_pixels, 1)
+        return np.sum((box_importance*relevant)[..., np.newaxis]*(mean_box[..., np.newaxis]/mean_field_region[..., np.newaxis])**momenta, axis=-2)
+
+    relevant = sea_n_box_pixels > 1
+    mean_box = sums/np.maximum(sea_n_box_pixels, 1)
+    variance = np.where(relevant, np.maximum(squares/np.maximum(sea_n_box_pixels, 1) - (mean_box - mean_field_region)**2, 0.0), 0.0)
+
+    if output == 'variance':
+        return np.sum(box_importance*variance, axis=-1)[..., np.newaxis]
+
+    return (np.sum(box_importance*np.sqrt(variance), axis=-1)/mean_field_region[..., 0])[..., np.newaxis]
+
+
+
+# The masked 2 x 2 reduction of the layers (sums of the values, sea pixel counts, sums of the squares) over the last two axes, an odd edge is padded by zeros (the boxes at the edge are then partial, as in the box layout of the scaling(...) function).
+
+def reduce_blocks(layers):
+
+    padding = [(0, 0)]*(np.ndim(layers) - 2) + [(0, np.shape(layers)[-2] % 2), (0, np.shape(layers)[-1] % 2)]
+    layers = np.pad(layers, padding)
+
+    return layers[..., 0::2, 0::2] + layers[..., 1::2, 0::2] + layers[..., 0::2, 1::2] + layers[..., 1::2, 1::2]
+
+
+
+# This evaluates the dyadic scales of the scaling(...) function by the coarse-graining pyramid: the layers of the field are reduced by 2 x 2 blocks level by level (O(N) work in total), the level j gives the boxes of 2**j x 2**j pixels laid from the top left corner. The boxes laid from the other 3 corners are the top left boxes of the flipped field, so the 4 pyramids give exactly the box layout (and the output) of box_moments_integral(...). Returns the outputs for the `levels' (in the given order), for stacked fields with the leading time axis.
+
+def box_moments_pyramid(field, mask, momenta, levels, output, mean_field_region, total_n_pixels_sea):
+
+    stack = np.shape(field)[:-2]
+    sea = field != mask
+    shift = np.reshape(mean_field_region, stack + (1, 1))
+    layers = np.stack((np.where(sea, field, 0.0), sea.astype(float), np.where(sea, (field - shift)**2, 0.0)))
+    mean_field_region = np.reshape(mean_field_region, stack + (1,))
+    total_n_pixels_sea = np.reshape(total_n_pixels_sea, stack + (1,))
+    het = dict((level, np.zeros(stack + (len(momenta),))) for level in levels)    # the variance and st_deviation are broadcast to all the momenta, as in box_moments_integral(...)
+
+    for axes in ((), (-2,), (-1,), (-2, -1)):
+
+        reduced = np.flip(layers, axis=axes) if axes else layers
+
+        for level in range(0, max(levels) + 1):
+
+            if level in het:
+                het[level] = het[level] + box_statistics(np.reshape(reduced, (3,) + stack + (-1,)), momenta, output, mean_field_region, total_n_pixels_sea)
+
+            if level < max(levels):
+                reduced = reduce_blocks(reduced)
+
+    return [het[level] for level in levels]
+
+
+
 # This function typically calculates scaling of the fluxes (captured by the more general `field' variable!). It calculates the statistical moments scaling for the moments supplied (`momenta') from minimal (`scale_min') to maximal (`scale_max') scale, scales separated by scaling coefficient (`scale_coeff').  The moments are calculated in boxes with the area A = scale**2. The boxes however might be squashed (non-rectangular) by the anisotropy coefficient (`anisotropy'). It is typical to set anisotropy = 1.0, implying that the boxes are squares. The boundaries and the land lead in general to smaller effective box area than A = scale**2. The boxes with smaller effective (not necessarily geometric!) area are included in the analysis with a lower statistical weight (the weight is simply proportional to the box effective area). To resolve the assymetry of the analysis introduced by the regional boundaries, the boxes are defined symmetrically from all 4 corners of the rectangular region.
  
 #This function is more general than just for the purpose of calculating statistical moments, it can calculate also mean variance per box, or mean standard deviation per box, as well as the scale ratio at which the fluxes were computed. What is calculated is determined by the `output' variable with possible four values: output = (moment, variance, st_deviation).
 
-#As before, there are two more arguments: latitudes and mask.
+#As before, there are two more arguments: latitudes and mask. The optional `method' argument selects how the box statistics are evaluated: method = 'integral' (default) builds the integral images of the field once (see integral_images(...)) and every box becomes an O(1) lookup, method = 'boxes' slices the field box by box. With method = 'integral' the `field' can also be a stack of fields on the same grid (time, lat, lon), the output then has the shape (time, scales, moments). Method = 'pyramid' replaces the geometric schedule of scales (where many scales differ only by a pixel after the rounding) by the dyadic boxes of 2**j x 2**j pixels (from scale_min up to scale_max) evaluated by the coarse-graining pyramid (see box_moments_pyramid(...)), with the `intermediate' number of non-dyadic box sizes (geometrically spread) between the neighbouring dyadic ones evaluated from the integral images (by default as many as the scale_coeff steps within an octave, 0 gives the dyadic scales only). The pyramid boxes are square in pixels (the latitudes and the anisotropy do not change them), the output layout is the same as for the other methods (and stacks are supported). The geometric factor comes from the `plan' (see multifractal_plan_pub), by default the cached plan of the field geometry, a plan of a single field also serves a stack of fields with its land mask. With non_negative = True (for the fields known to be non-negative, as the eta-fluxes of double_trace_moments(...)) the box sums of the integral images are clipped at 0 for output = 'moment', as their cancellations can fall slightly below zero for a large dynamic range of the field. The fields with negative values keep their negative box means.
 
-def scaling(field, momenta, scale_max, scale_min, scale_coeff, anisotropy, output, latitudes, mask):
+@mhp.timed('scaling')
+def scaling(field, momenta, scale_max, scale_min, scale_coeff, anisotropy, output, latitudes, mask, method = 'integral', intermediate = None, plan = None, non_negative = False):
 
 # Defines main parameters used in the calculation.
 
 
-    theta = np.mean(latitudes[field != mask])
-    geometric_factor = np.cos(np.pi*theta/180.0)
+    plan = mpl.get_plan(field, latitudes, mask) if plan is None else plan
+    geometric_factor = plan.geometric_factor
 
-    (region_height,region_width) = np.shape(field)
+    (region_height,region_width) = np.shape(field)[-2:]
     n_pixels = region_width*region_height
-    mean_field_region = np.mean(field[field != 0])
+    total_n_pixels_sea = np.count_nonzero(field != 0, axis=(-2, -1))
+    mean_field_region = np.sum(np.where(field != 0, field, 0.0), axis=(-2, -1))/total_n_pixels_sea
     mean_het = []
     scale = np.array([])
-    total_n_pixels_sea = len(field[field != 0])
     step = 1.0
     length = scale_min
     n_moments = len(momenta)
 
+    if intermediate is None:
+        intermediate = max(int(round(np.log(2.0)/np.log(scale_coeff))) - 1, 0)
+
+    if (method == 'integral') | ((method == 'pyramid') & (intermediate > 0)):
+        tables = integral_images(field, mask, np.reshape(mean_field_region, np.shape(mean_field_region) + (1, 1)))
+
+    if method == 'pyramid':
+
+        levels = [level for level in range(0, int(np.log2(max(region_height, region_width))) + 1) if (2**level >= scale_min) & (2**level < scale_max) & (mbf.round_up(region_height/2.0**level) > 1) & (mbf.round_up(region_width/2.0**level) > 1)]
+        sides = [2**level for level in levels]
+        mean_het = box_moments_pyramid(field, mask, momenta, levels, output, mean_field_region, total_n_pixels_sea) if levels else []
+
+        for (level_1, level_2) in zip(levels[:-1], levels[1:]):
+            for side in np.unique(np.round(2.0**(level_1 + np.arange(1, intermediate + 1)/(intermediate + 1.0)))):
+                if (side > 2**level_1) & (side < 2**level_2):
+                    sides.append(side)
+                    mean_het.append(box_moments_integral(tables, momenta, side, side, output, mean_field_region, total_n_pixels_sea, non_negative))
+
+        order = np.argsort(sides, kind='stable')
+        mean_het = [mean_het[index] for index in order]
+        scale = np.sqrt(np.asarray(sides, dtype=float)[order]**2/n_pixels)
+
 # This is the main while-loop running through all the scales. 
 
-    while length < scale_max:    
+    while (length < scale_max) & (method != 'pyramid'):    
 
         n_box_pixels = np.round(length**2.0/geometric_factor)+0.0
         n_box_pixels_lat = np.round(np.sqrt(n_box_pixels*geometric_factor/anisotropy))+0.0
@@ -95,58 +252,64 @@ def scaling(field, momenta, scale_max, scale_min, scale_coeff, anisotropy, outpu
             
             if (n_boxes_long > 1) & (n_boxes_lat > 1):
 
+                if method == 'integral':
+
+                    het = box_moments_integral(tables, momenta, n_box_pixels_lat, n_box_pixels_long, output, mean_field_region, total_n_pixels_sea, non_negative)
+
+                else:
+
 # Loop through the individual boxes:
 
-                for box_long in range(1, n_boxes_long+1):
-                    for box_lat in range(1, n_boxes_lat+1): 
+                    for box_long in range(1, n_boxes_long+1):
+                        for box_lat in range(1, n_boxes_lat+1): 
  
 # The individual box has 4 different coordinates corresponding to the analysis that originated from 4 different regional vortices.
        
-                        for iterate in range(1,5):
+                            for iterate in range(1,5):
                             
-                            if iterate == 1:
+                                if iterate == 1:
                                 
-                                coordinate_long_1 = (box_long-1)*n_box_pixels_long
-                                coordinate_long_2 = min(box_long*n_box_pixels_long, region_width) 
-                                coordinate_lat_1 = (box_lat-1)*n_box_pixels_lat
-                                coordinate_lat_2 = min(box_lat*n_box_pixels_lat, region_height)
+                                    coordinate_long_1 = (box_long-1)*n_box_pixels_long
+                                    coordinate_long_2 = min(box_long*n_box_pixels_long, region_width) 
+                                    coordinate_lat_1 = (box_lat-1)*n_box_pixels_lat
+                                    coordinate_lat_2 = min(box_lat*n_box_pixels_lat, region_height)
              
-                            if iterate == 2:
+                                if iterate == 2:
               
-                                coordinate_long_2 = region_width - (box_long-1)*n_box_pixels_long
-                                coordinate_long_1 = max(region_width - box_long * n_box_pixels_long, 0)  
+                                    coordinate_long_2 = region_width - (box_long-1)*n_box_pixels_long
+                                    coordinate_long_1 = max(region_width - box_long * n_box_pixels_long, 0)  
               
-                            if iterate == 3:
+                                if iterate == 3:
             
-                                coordinate_lat_2 = region_height - (box_lat-1)*n_box_pixels_lat              
-                                coordinate_lat_1 = max(region_height - box_lat*n_box_pixels_lat, 0)
+                                    coordinate_lat_2 = region_height - (box_lat-1)*n_box_pixels_lat              
+                                    coordinate_lat_1 = max(region_height - box_lat*n_box_pixels_lat, 0)
               
-                            if iterate == 4: 
+                                if iterate == 4: 
             
-                                coordinate_long_1 = (box_long-1)*n_box_pixels_long
-                                coordinate_long_2 = min(box_long*n_box_pixels_long, region_width)
+                                    coordinate_long_1 = (box_long-1)*n_box_pixels_long
+                                    coordinate_long_2 = min(box_long*n_box_pixels_long, region_width)
             
              
-                            field_box = field[coordinate_lat_1 : coordinate_lat_2, coordinate_long_1 : coordinate_long_2]
-                            box_size_pixels = (coordinate_long_2 + 1 - coordinate_long_1)*(coordinate_lat_2 + 1 - coordinate_lat_1)
-                            sea_n_box_pixels = len(field_box[field_box != mask])+0.0
-                            box_importance = sea_n_box_pixels/(4*total_n_pixels_sea)
+                                field_box = field[int(coordinate_lat_1) : int(coordinate_lat_2), int(coordinate_long_1) : int(coordinate_long_2)]
+                                box_size_pixels = (coordinate_long_2 + 1 - coordinate_long_1)*(coordinate_lat_2 + 1 - coordinate_lat_1)
+                                sea_n_box_pixels = len(field_box[field_box != mask])+0.0
+                                box_importance = sea_n_box_pixels/(4*total_n_pixels_sea)
 
 
 # This records the desired parameter of the analysis.
 
             
-                            if (output == 'moment') & (sea_n_box_pixels > 0):
+                                if (output == 'moment') & (sea_n_box_pixels > 0):
             
-                                het += box_importance * (np.mean(field_box[field_box != mask])/mean_field_region)**momenta
+                                    het += box_importance * (np.mean(field_box[field_box != mask])/mean_field_region)**momenta
               
-                            if (output == 'variance') & (sea_n_box_pixels > 1):
+                                if (output == 'variance') & (sea_n_box_pixels > 1):
   
-                                het += box_importance * np.var(field_box[field_box != mask])
+                                    het += box_importance * np.var(field_box[field_box != mask])
    
-                            if (output == 'st_deviation') & (sea_n_box_pixels > 1): 
+                                if (output == 'st_deviation') & (sea_n_box_pixels > 1): 
   
-                                het += box_importance * np.sqrt(np.var(field_box[field_box != mask]))/mean_field_region
+                                    het += box_importance * np.sqrt(np.var(field_box[field_box != mask]))/mean_field_region
                             
                 mean_het.append(het)
                 scale = np.append(scale, np.sqrt(eff_n_box_pixels/n_pixels))
@@ -154,78 +317,241 @@ def scaling(field, momenta, scale_max, scale_min, scale_coeff, anisotropy, outpu
         length = scale_min*scale_coeff**step
         step+=1     
         
+
+    if len(mean_het) > 0:
+        return np.moveaxis(np.asarray(mean_het), 0, -2), scale    # for a stack of fields the shape is (time, scales, moments)
    
     return np.asarray(mean_het), scale
 
 
 
-# This function computes the field increments scaling. It has similar structure as the previous function (for the details see the function scaling(...)), except the output is always 'moments'. The increments are computed around the circle with the radius = scale across all the relevant points of the region. It is as always assumed that field = 0 means `masked', or in other words land. The scale is here returned with values in grid pixels, rather than in values of the maximal scale. This is a difference to the previous scaling(...) function.
+# This returns the sums of values**momenta over all the (non-negative) values, for all the momenta at once. If the momenta are equally spaced (as the default ones are), the powers are obtained by repeated multiplication, which is considerably cheaper than the general broadcasted power.
+
+def moment_sums(values, momenta):
+
+    momenta = np.asarray(momenta, dtype=float)
+    steps = np.diff(momenta)
+
+    if (len(momenta) > 2) and (momenta[0] >= 0) and (steps[0] > 0) and np.allclose(steps, steps[0], rtol=0, atol=1e-12):
+
+        factor = values**steps[0]
+        power = values**momenta[0]
+        sums = np.zeros((len(momenta)))
+
+        for moment in range(0, len(momenta)):
+            sums[moment] = np.sum(power)
+            if moment < len(momenta) - 1:
+                power *= factor
+
+        return sums
+
+    return np.sum(values[:, np.newaxis]**momenta, axis=0)
+
+
+
+# This function computes the field increments scaling. It has similar structure as the previous function (for the details see the function scaling(...)), except the output is always 'moments'. The increments are computed around the circle with the radius = scale across all the relevant points of the region. It is as always assumed that field = 0 means `masked', or in other words land. The scale is here returned with values in grid pixels, rather than in values of the maximal scale. This is a difference to the previous scaling(...) function. The circle is not walked pixel by pixel: for every circle offset the increments are taken between the field and its shifted copy over the whole array at once, with all the moments raised in one broadcasted power. The `field' can also be a stack of fields on the same grid (time, lat, lon), the circle geometry is then shared and the output has the shape (time, scales, moments). The circles and the longitudal shifts come from the `plan' (see multifractal_plan_pub), by default the cached plan of the field geometry, so they are shared also between the calls.
 
 #As before, there are two more arguments: latitudes and mask.
 
-def scaling_increments(field, momenta, scales_inc_an, latitudes, mask): 
+@mhp.timed('scaling_increments')
+def scaling_increments(field, momenta, scales_inc_an, latitudes, mask, plan = None): 
 
-    (region_height, region_width) = np.shape(field)
+    (region_height, region_width) = np.shape(field)[-2:]
+    stack = np.reshape(field, (-1, region_height, region_width))    # a single field is a stack of one
     delta_field = []
     scale = []
+    sea = stack != mask
+    plan = mpl.get_plan(field, latitudes, mask) if plan is None else plan    # The geometric correction and the circles are computed once for all the pixels and scales (and calls).
 
-    for length in scales_inc_an:
+    for (scale_index, length) in enumerate(scales_inc_an):
   
-        cases=0.0
-        delta=np.zeros((len(momenta)))
+        cases = np.zeros((len(stack)))
+        delta = np.zeros((len(stack), len(momenta)))
 
-# This loop goes through individual pixels (/points).
-        
-        for pixel_long in range(0, region_width):
-            for pixel_lat in range(0, region_height): 
+# This loop goes through the circle with radius = scale, for each offset it takes all the relevant pixel pairs of the region.
 
-# This inner loop goes through the circle with radius = scale and the center at the individual point of the outer loop.
-        
-                for n_x in range(int(-length),int(length)+1):
-                    for sign in range(-1,2,2):
+        for ((n_x, n_y), multiplicity) in plan.circle(length).items():
 
-                        n_y = sign*np.round(np.sqrt(length**2-n_x**2))
-                        coordinate_long = pixel_long + n_x/np.cos(np.pi*latitudes[pixel_lat, pixel_long]/180.0)
-                        coordinate_lat = pixel_lat + n_y
-          
-                        if (region_width > coordinate_long >= 0) & (region_height > coordinate_lat >= 0):
-            
-                            if (field[pixel_lat, pixel_long] != mask) & (field[coordinate_lat, coordinate_long] != mask):                              
-                         
-                                delta += np.abs(field[pixel_lat, pixel_long]-field[coordinate_lat, coordinate_long])**momenta
-                                cases+=1            
+            (shift_long, shift_values) = plan.shift_long(n_x)    # The longitudal offset in pixels, it depends on the latitude of the centre pixel.
+
+            for n_long in shift_values:
+
+                (centre, neighbour) = shifted_slices(n_y, n_long, (region_height, region_width))
+                valid = sea[centre] & sea[neighbour]
+
+                if len(shift_values) > 1:
+                    valid &= np.broadcast_to(shift_long, (region_height, region_width))[centre] == n_long    # the plan keeps the shifts in their compact (e.g. per row) form
+
+                differences = np.abs(stack[centre] - stack[neighbour])
+
+                for index in range(0, len(stack)):
+                    increments = differences[index][valid[index]]
+                    delta[index] += multiplicity*moment_sums(increments, momenta)
+                    cases[index] += multiplicity*len(increments)
           
-        if cases > 10: 
-            delta_field.append(delta/(cases+0.0))
+        if np.all(cases > 10): 
+            delta_field.append(np.reshape(delta/cases[:, np.newaxis], np.shape(field)[:-2] + (len(momenta),)))
             scale = np.append(scale, length)
+
+        mhp.progress('scaling_increments', scale = length, scales_done = scale_index + 1, n_scales = len(scales_inc_an))
     
-        
+    if len(delta_field) > 0:
+        return np.moveaxis(np.asarray(delta_field), 0, -2), scale    # for a stack of fields the shape is (time, scales, moments)
                 
     return np.asarray(delta_field), scale[0:len(delta_field)]
 
 
 
 
-# This is a function that calculates the universal multifractal (2-parametric) fit of the moments scaling function K. It returns the two parameters (alpha and C_1) and also the error of the fit. The names of the output variables are self-explanatory. The input is the K function to be fitted and also the relevant range of moments of the fit (must be consistent with K!). Since the range of relevant values of the C_1 ('C') parameter is largely case dependent, the fitting function allows to take the estimated relevant range as an argument. Also to keep the speed of the analysis optimal it allows the user to define the C fit resolution through the `C_step' variable. This is set automatically for the alpha parameter. The fit is based on minimizing the relative error.
 
+# The sums of the integral image `table' over all the windows of n_lat x n_long pixels (one window per position of its top left corner), the output has the shape (..., region_height - n_lat + 1, region_width - n_long + 1).
+
+def window_sums(table, n_lat, n_long):
 
-def UM_fit(K, momenta, C_min, C_max, C_step):
+    return table[..., n_lat:, n_long:] - table[..., :-n_lat, n_long:] - table[..., n_lat:, :-n_long] + table[..., :-n_lat, :-n_long]
+
+
+
+# The Haar fluctuation analysis, an alternative to scaling_increments(...) with the same output. The Haar fluctuation at the scale `length' is the difference of the mean sea values of the two halves of the box of length x length (the longitudal side being divided by the geometric factor of the mean latitude, as in scaling(...)), the boxes are split both in the latitudal and in the longitudal direction and are taken at all the positions in the region. The half-box means come from the integral images of the field (see integral_images(...)), so every scale takes O(N) operations and no circle is walked. A half-box is relevant when at least a half of its pixels are sea. The fluctuations are multiplied by the `calibration' factor (2 by default), which makes them close to the increments for 0 < H < 1 (so the fluctuation size of UM_parameters(...) stays comparable), unlike the increments the Haar fluctuations scale with H also for -1 < H < 0. The scales that fall onto the same half-box sizes are evaluated once and the returned scales (in pixels) are the effective box sizes. The output is (the moments of the fluctuations of the shape (scales, moments), the scales), for a stack of fields (time, scales, moments). The geometric factor comes from the `plan' (see multifractal_plan_pub).
+
+@mhp.timed('scaling_haar')
+def scaling_haar(field, momenta, scales_inc_an, latitudes, mask, calibration = 2.0, plan = None):
+
+    (region_height, region_width) = np.shape(field)[-2:]
+    stack = np.reshape(field, (-1, region_height, region_width))    # a single field is a stack of one
+    plan = mpl.get_plan(field, latitudes, mask) if plan is None else plan
+    geometric_factor = plan.geometric_factor
+    tables = integral_images(stack, mask, 0.0)[:2]
+    fluctuations = []
+    scale = []
+    halves = set()
+
+    for (scale_index, length) in enumerate(scales_inc_an):
+
+        half_lat = max(int(np.round(length/2.0)), 1)
+        half_long = max(int(np.round(length/(2.0*geometric_factor))), 1)
+
+        if ((half_lat, half_long) in halves) | (2*half_lat > region_height) | (2*half_long > region_width):
+            continue
+
+        halves.add((half_lat, half_long))
+        cases = np.zeros((len(stack)))
+        moments = np.zeros((len(stack), len(momenta)))
+
+# The box split in the longitudal direction (windows of 2*half_lat x half_long) and in the latitudal direction (windows of half_lat x 2*half_long).
+
+        for (n_lat, n_long, first, second) in ((2*half_lat, half_long, (Ellipsis, slice(None), slice(None, -half_long)), (Ellipsis, slice(None), slice(half_long, None))), (half_lat, 2*half_long, (Ellipsis, slice(None, -half_lat), slice(None)), (Ellipsis, slice(half_lat, None), slice(None)))):
+
+            (sums, counts) = [window_sums(table, n_lat, n_long) for table in tables]
+            counts = np.round(counts)
+            relevant = np.minimum(counts[first], counts[second]) >= n_lat*n_long/2.0
+            means = sums/np.maximum(counts, 1)
+            differences = calibration*np.abs(means[first] - means[second])
+
+            for index in range(0, len(stack)):
+                values = differences[index][relevant[index]]
+                moments[index] += moment_sums(values, momenta)
+                cases[index] += len(values)
+
+        if np.all(cases > 10):
+            fluctuations.append(np.reshape(moments/cases[:, np.newaxis], np.shape(field)[:-2] + (len(momenta),)))
+            scale = np.append(scale, 2*np.sqrt(half_lat*half_long*geometric_factor))
+
+        mhp.progress('scaling_haar', scale = length, scales_done = scale_index + 1, n_scales = len(scales_inc_an))
+
+    if len(fluctuations) > 0:
+        return np.moveaxis(np.asarray(fluctuations), 0, -2), scale    # for a stack of fields the shape is (time, scales, moments)
+
+    return np.asarray(fluctuations), np.asarray(scale)
+
+
+
+# This returns the relative errors of the universal multifractal fit of the moment scaling function K for all the combinations of the C values (rows) and alpha values (columns) at once. The UM model is linear in C, so the moments part is computed only once per alpha value.
+
+def UM_fit_errors(K, momenta, C_values, alpha_values):
+
+    relevant = momenta != 1
+    q = momenta[relevant]
+    K_relevant = K[relevant]
+    alpha_values = np.asarray(alpha_values)[:, np.newaxis]
+    model_alpha = (q**alpha_values - q)/(alpha_values - 1.0)    # The UM model for C = 1, shape (alpha, moments).
+    model = np.asarray(C_values)[:, np.newaxis, np.newaxis]*model_alpha[np.newaxis, :, :]
+
+    return np.mean(np.abs((model - K_relevant)/K_relevant), axis=2)
+
+
+
+# This is a function that calculates the universal multifractal (2-parametric) fit of the moments scaling function K. It returns the two parameters (alpha and C_1) and also the error of the fit. The names of the output variables are self-explanatory. The input is the K function to be fitted and also the relevant range of moments of the fit (must be consistent with K!). Since the range of relevant values of the C_1 ('C') parameter is largely case dependent, the fitting function allows to take the estimated relevant range as an argument. Also to keep the speed of the analysis optimal it allows the user to define the C fit resolution through the `C_step' variable. This is set automatically for the alpha parameter. The fit is based on minimizing the relative error. The errors are evaluated as broadcasted grids. With `refine' = True (default) the search is coarse-to-fine: the continuous optimum of C is found for every alpha value first and then only the neighbouring grid C values are evaluated, with `refine' = False the whole grid is evaluated. With `polish' = True the grid minimum is further polished by a continuous optimizer (the result then is no longer restricted to the grid).
+
+
+def UM_fit(K, momenta, C_min, C_max, C_step, refine = True, polish = False):
 
     C_fit = C_min
     alpha_fit = 0.005
-    error = np.mean(np.abs(((C_fit/(alpha_fit-1.0))*(momenta[momenta != 1]**alpha_fit - momenta[momenta != 1])-K[momenta != 1])/K[momenta != 1]))
-    n_C_elements = mbf.round_up((C_max-C_min)/C_step)
+    error = UM_fit_errors(K, momenta, [C_fit], [alpha_fit])[0, 0]
+    n_C_elements = int(mbf.round_up((C_max-C_min)/C_step))
     C_elements = np.linspace(C_min, C_max, num=n_C_elements)
     alpha_elements = np.linspace(0.01, 2.0, num=400)
     alpha_elements = alpha_elements[alpha_elements != 1]
 
-    for C in C_elements:
-        for alpha in alpha_elements:  
-        
-            if np.mean(np.abs(((C/(alpha-1.0))*(momenta[momenta != 1]**alpha - momenta[momenta != 1]) - K[momenta != 1] )/ K[momenta != 1]))  < error:
-                error = np.mean(np.abs(((C/(alpha-1.0))*(momenta[momenta != 1]**alpha - momenta[momenta != 1])- K[momenta != 1] ) / K[momenta != 1]))
-                alpha_fit = alpha
-                C_fit = C
+    if refine:
+
+# Coarse step: for a fixed alpha the error is sum_i w_i*|C - r_i| with r_i = K_i/model_i and w_i = |model_i/K_i| (model_i being the UM model for C = 1). This is convex in C and minimal at the weighted median of r_i, which is found for all alpha values at once. Fine step: only the grid C values around this minimum are evaluated.
+
+        relevant = momenta != 1
+        model_alpha = (momenta[relevant]**alpha_elements[:, np.newaxis] - momenta[relevant])/(alpha_elements[:, np.newaxis] - 1.0)
+        ratios = K[relevant]/model_alpha
+        weights = np.abs(model_alpha/K[relevant])
+        order = np.argsort(ratios, axis=1)
+        ratios = np.take_along_axis(ratios, order, axis=1)
+        cumulative = np.cumsum(np.take_along_axis(weights, order, axis=1), axis=1)
+        median = np.argmax(cumulative >= cumulative[:, -1:]/2.0, axis=1)
+        C_optimal = ratios[np.arange(len(alpha_elements)), median]
+
+        if len(C_elements) > 1:
+            C_position = np.floor((C_optimal - C_min)/(C_elements[1] - C_elements[0]))
+        else:
+            C_position = np.zeros((len(alpha_elements)))
+
+        candidates = np.clip(C_position[:, np.newaxis] + np.arange(-1, 3), 0, len(C_elements)-1).astype(int)
+        errors = np.mean(np.abs((C_elements[candidates][:, :, np.newaxis]*model_alpha[:, np.newaxis, :] - K[relevant])/K[relevant]), axis=2)
+
+# The first minimum in the (C, alpha) order is taken, as in the full grid search.
+
+        best = np.lexsort((np.repeat(np.arange(len(alpha_elements))[:, np.newaxis], 4, axis=1).ravel(), candidates.ravel(), errors.ravel()))[0]
+        best_alpha = best//4
+        best_C = candidates.ravel()[best]
+        grid_error = errors.ravel()[best]
+
+    else:
+
+# The full grid, evaluated in blocks of C values to keep the memory modest. The first minimum in the (C, alpha) order is taken.
+
+        grid_error = error
+        best_C = 0
+        best_alpha = 0
+
+        for block in range(0, len(C_elements), 200):
+
+            errors = UM_fit_errors(K, momenta, C_elements[block:block+200], alpha_elements)
+
+            if np.min(errors) < grid_error:
+                grid_error = np.min(errors)
+                (best_C, best_alpha) = np.unravel_index(np.argmin(errors), np.shape(errors))
+                best_C += block
+
+    if grid_error < error:
+        error = grid_error
+        alpha_fit = alpha_elements[best_alpha]
+        C_fit = C_elements[best_C]
+
+    if polish:
+
+        result = minimize(lambda x: UM_fit_errors(K, momenta, [x[1]], [x[0]])[0, 0], [alpha_fit, C_fit], method='Nelder-Mead')
+
+        if (result.fun < error) & (0 < result.x[0] <= 2.0) & (C_min <= result.x[1] <= C_max):
+            (alpha_fit, C_fit) = result.x
+            error = result.fun
         
     return alpha_fit, C_fit, error
 
@@ -234,6 +560,7 @@ def UM_fit(K, momenta, C_min, C_max, C_step):
 # This function calculates the 3 scaling parameters H, C_1, alpha and also the remaining scaling information. The moment scaling function is computed through standard linear interpolation. The alpha, C_1 parameters are computed through the fit provided by UM_fit(...) function. The remaining scaling information is the outer scale of the process `outer_scale' parameter and also the fluctuation characteristic sizes. The function output is = (the moment scaling function K, the UM parameters). The UM parameter output of the function is: [H, alpha, C_1, outer_scale, fluctuation size, the error of the UM fit]. There are two separate moments: moments for increments (momenta_inc) and for fluxes (momenta_flux). This small complication is due to the fact that due to numerical computational reasons it is sometimes convenient to select the moments for fluxes and increments slightly differently. Note for example module defining the parameters for the analysis.
 
 
+@mhp.timed('UM_parameters')
 def UM_parameters(flux_scaling, inc_scaling, scales_flux, scales_inc, momenta_flux, momenta_inc):
  
     H =  np.cov(np.log(inc_scaling[: , np.argwhere(momenta_inc == 1)[0][0]]), np.log(scales_inc))[0][1]/np.var(np.log(scales_inc))
@@ -242,14 +569,14 @@ def UM_parameters(flux_scaling, inc_scaling, scales_flux, scales_inc, momenta_fl
     K = np.zeros((n_moments))
     a_flux = np.zeros((n_moments))   
     
-    scale_max = (2/3.0)*len(scales_flux) # scale_max gives the upper scale of the flux scaling Log-log linear interpolation. Due to flux homogeneity scale the Log-log scaling eventually deviates from the straight line and there is only limited range of scales where the linear fit makes good sense. (In the best case scenario the linear scaling breakdown will be close to the flux homogeneity scale.)
+    scale_max = int((2/3.0)*len(scales_flux)) # scale_max gives the upper scale of the flux scaling Log-log linear interpolation. Due to flux homogeneity scale the Log-log scaling eventually deviates from the straight line and there is only limited range of scales where the linear fit makes good sense. (In the best case scenario the linear scaling breakdown will be close to the flux homogeneity scale.)
 
     for corr in range(0,4):   # This loop fixes the range of scales of the linear interpolation (the loop should converge to some range of scales where the Log-log scaling curves are roughly straight lines).
 
         K_test = np.cov(-np.log(flux_scaling[:scale_max, 10]), np.log(scales_flux[:scale_max]))[0][1]/np.var(np.log(scales_flux[:scale_max]))
         a_test = np.mean(np.log(flux_scaling[:scale_max, 10])) + K_test*np.mean(np.log(scales_flux[:scale_max]))
         line = -K_test*np.log(scales_flux) + a_test
-        scale_max = (2/3.0)*len(line[line>0])
+        scale_max = int((2/3.0)*len(line[line>0]))
 
     scales_flux = scales_flux[:scale_max]
     flux_scaling = flux_scaling[0:scale_max,:]
@@ -269,3 +596,133 @@ def UM_parameters(flux_scaling, inc_scaling, scales_flux, scales_inc, momenta_fl
 
 
 
+
+
+
+# The Double Trace Moment (DTM) analysis of the flux: the flux is raised to the powers `etas' (and each eta-flux is normalized by its mean), all the eta-fluxes are coarse-grained together as one stack by the scaling(...) function (so the boxes and their sea pixel counts are evaluated only once per scale) and the moment scaling functions K(q, eta) are the log-log slopes of their moments `momenta' over the first `n_scales' scales (by default the first 2/3 of them, as the first guess of UM_parameters(...)). For the universal multifractals K(q, eta) = eta**alpha*K(q), so alpha is the slope of log|K(q, eta)| against log(eta) (averaged over the momenta) and C_1 follows from the intercept K(q) = C_1/(alpha - 1)*(q**alpha - q). The slope is fitted over the etas with finite |K(q, eta)| > 0 (up to the first invalid one, e.g. lost by the cancellations of the integral images for the large etas) below the divergence of the moments (where the slope first drops to a half of its small-eta value). This gives alpha and C_1 directly and much more cheaply than the grid search of UM_fit(...). The output is (K(q, eta) of the shape (etas, momenta), [alpha, C_1, the mean relative error of the fit of K(q, eta)]), for a stack of fluxes (time, lat, lon) both have the leading time axis.
+
+@mhp.timed('DTM')
+def double_trace_moments(flux, momenta, etas, scale_max, scale_min, scale_coeff, latitudes, mask, method = 'integral', n_scales = None, plan = None):
+
+    etas = np.asarray(etas, dtype=float)
+    momenta = np.asarray(momenta, dtype=float)
+    sea = flux != mask
+    eta_fluxes = np.where(sea, np.abs(np.where(sea, flux, 1.0))**np.reshape(etas, (-1,) + (1,)*np.ndim(flux)), mask)
+
+    plan = mpl.get_plan(flux, latitudes, mask) if plan is None else plan    # the plan of the flux serves all the eta-fluxes
+    (moments, scales) = scaling(eta_fluxes, momenta, scale_max, scale_min, scale_coeff, 1.0, 'moment', latitudes, mask, method = method, plan = plan, non_negative = True)    # the eta-fluxes are non-negative, their box sums below zero are the cancellations of the integral images
+
+    n_scales = max(int((2/3.0)*len(scales)), 2) if n_scales is None else n_scales
+    log_scales = np.log(scales[:n_scales])
+    log_moments = np.log(moments[..., :n_scales, :])
+    K = -np.sum((log_moments - np.mean(log_moments, axis=-2, keepdims=True))*(log_scales - np.mean(log_scales))[:, np.newaxis], axis=-2)/np.sum((log_scales - np.mean(log_scales))**2)
+    K = np.moveaxis(K, 0, -2)    # (..., etas, momenta)
+
+    fits = [DTM_fit(K_time, momenta, etas) for K_time in np.reshape(K, (-1, len(etas), len(momenta)))]
+
+    return K, np.reshape(fits, np.shape(K)[:-2] + (3,))
+
+
+
+# The UM fit of the double trace moment scaling functions K(q, eta) (of the shape (etas, momenta)), see double_trace_moments(...). Returns [alpha, C_1, error].
+
+def DTM_fit(K, momenta, etas):
+
+    alphas = []
+    C_values = []
+    errors = []
+
+    for (moment, K_eta) in zip(momenta, K.T):
+
+        if moment == 1:
+            continue
+
+        valid = np.cumprod(np.isfinite(K_eta) & (np.abs(np.nan_to_num(K_eta)) > 0)) > 0    # the etas up to the first invalid K(q, eta)
+
+        if np.count_nonzero(valid) < 2:
+            continue
+
+        slopes = np.gradient(np.log(np.abs(K_eta[valid])), np.log(etas[valid]))
+        relevant = np.zeros(np.shape(valid), dtype=bool)
+        relevant[valid] = np.cumsum(slopes < slopes[0]/2.0) == 0    # the moments beyond the divergence give the flattening of K(q, eta)
+
+        if np.count_nonzero(relevant) < 2:
+            continue
+
+        (alpha, intercept) = np.polyfit(np.log(etas[relevant]), np.log(np.abs(K_eta[relevant])), 1)
+        model = etas[relevant]**alpha*np.exp(intercept)*np.sign(K_eta[relevant])
+        alphas.append(alpha)
+        C_values.append(np.exp(intercept)*abs(alpha - 1)/abs(moment**alpha - moment) if abs(alpha - 1) > 1e-6 else np.exp(intercept)/abs(moment*np.log(moment)))
+        errors.append(np.mean(np.abs((model - K_eta[relevant])/K_eta[relevant])))
+
+    if not alphas:
+        return np.array([np.nan, np.nan, np.nan])
+
+    return np.array([np.mean(alphas), np.mean(C_values), np.mean(errors)])
+
+
+
+
+
+
+# The isotropic power spectrum of the field, E(k) ~ k*<|F(k)|**2> averaged in the logarithmic bins of the radial wavenumber k (in cycles per pixel of the latitudal direction, the longitudal wavenumbers are divided by the geometric factor of the mean latitude, as in the fluxes(...) function). The land is filled by the mean of the sea values and the sea anomaly is tapered by the 2-D Hann window, the power is divided by the mean square of the (sea x Hann) window, which corrects for the missing land and the tapering. `n_bins' is the number of the bins (by default 4 per octave of the wavenumbers). Returns the bin wavenumbers (geometric centres) and the spectrum, the empty bins are dropped. The `field' can also be a stack of fields (time, lat, lon), then the spectrum has the leading time axis. It takes O(N log N) operations.
+
+@mhp.timed('spectrum')
+def spectrum(field, latitudes, mask, n_bins = None, plan = None):
+
+    (region_height, region_width) = np.shape(field)[-2:]
+    stack = np.shape(field)[:-2]
+    sea = field != mask
+    geometric_factor = (mpl.get_plan(field, latitudes, mask) if plan is None else plan).geometric_factor
+
+    window = np.outer(np.hanning(region_height + 2)[1:-1], np.hanning(region_width + 2)[1:-1])*sea
+    mean_sea = np.sum(np.where(sea, field, 0.0), axis=(-2, -1))/np.maximum(np.count_nonzero(sea, axis=(-2, -1)), 1)
+    anomaly = np.where(sea, field - np.reshape(mean_sea, stack + (1, 1)), 0.0)*window
+    power = np.abs(np.fft.rfft2(anomaly))**2/np.reshape(np.mean(window**2, axis=(-2, -1))*region_height*region_width, stack + (1, 1))
+
+    k_lat = np.fft.fftfreq(region_height)
+    k_long = np.fft.rfftfreq(region_width)/geometric_factor
+    wavenumber = np.sqrt(k_lat[:, np.newaxis]**2 + k_long[np.newaxis, :]**2)
+
+# The half-plane of the real FFT counts the columns 1 .. (width-1)/2 twice (for their negative counterparts).
+
+    multiplicity = np.full(np.shape(wavenumber), 2.0)
+    multiplicity[:, 0] = 1.0
+    if region_width % 2 == 0:
+        multiplicity[:, -1] = 1.0
+
+    k_min = 1.0/max(region_height, region_width*geometric_factor)
+    k_max = np.max(wavenumber)
+    n_bins = int(np.ceil(4*np.log2(k_max/k_min))) if n_bins is None else n_bins
+    edges = k_min*(k_max/k_min)**(np.arange(0, n_bins + 1)/(n_bins + 0.0))
+    bins = np.digitize(wavenumber, edges) - 1
+    inside = (bins >= 0) & (bins < n_bins) & (wavenumber > 0)
+
+    counts = np.bincount(bins[inside], weights=multiplicity[inside], minlength=n_bins)
+    sums = np.array([np.bincount(bins[inside], weights=(multiplicity*layer)[inside], minlength=n_bins) for layer in np.reshape(power, (-1,) + np.shape(wavenumber))])
+    filled = counts > 0
+    wavenumbers = np.sqrt(edges[:-1]*edges[1:])[filled]
+
+    return wavenumbers, np.reshape(wavenumbers*sums[:, filled]/counts[filled], stack + (-1,))
+
+
+
+# The spectral slope beta (E(k) ~ k**(-beta)) fitted in the log-log plane over the wavenumbers within the `fit_range' (by default from 4 cycles per region to 1/4 cycles per pixel, i.e. the scales from 4 pixels to a quarter of the region, away from the window and the grid effects), and the implied H = (beta - 1 + K(2))/2, where K(2) is the moment scaling function at q = 2 (the intermittency correction, it is ignored for K_2 = 0). Returns (the array [beta, H, k_1, k_2] with the wavenumber range actually used, the wavenumbers, the spectrum), for a stack of fields the array has the leading time axis. This is a quick-look (O(N log N)) counterpart of the H from the increments scaling.
+
+def spectral_parameters(field, latitudes, mask, fit_range = None, n_bins = None, K_2 = 0.0, plan = None):
+
+    (wavenumbers, power) = spectrum(field, latitudes, mask, n_bins, plan)
+
+    if fit_range is None:
+        fit_range = (4.0*wavenumbers[0], 0.25)
+
+    fitted = (wavenumbers >= fit_range[0]) & (wavenumbers <= fit_range[1])
+    (k_1, k_2) = (np.min(wavenumbers[fitted]), np.max(wavenumbers[fitted])) if np.any(fitted) else (np.nan, np.nan)
+    parameters = []
+
+    for (layer, K) in zip(np.reshape(power, (-1, len(wavenumbers))), np.broadcast_to(K_2, (int(np.prod(np.shape(field)[:-2])),))):
+        valid = fitted & (layer > 0)
+        beta = -np.polyfit(np.log(wavenumbers[valid]), np.log(layer[valid]), 1)[0] if np.count_nonzero(valid) > 1 else np.nan
+        parameters.append([beta, (beta - 1 + K)/2.0, k_1, k_2])
+
+    return np.reshape(parameters, np.shape(field)[:-2] + (4,)), wavenumbers, power
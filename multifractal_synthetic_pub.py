@@ -0,0 +1,137 @@
+
+# This module generates synthetic universal multifractal (UM) fields with known parameters (H, alpha, C_1), e.g. to validate the analysis of the multifractal_class_pub module, or to benchmark at realistic grid sizes. The flux is a continuous in scale cascade: the exponential of the extremal Levy noise (of the index alpha) convolved with the power-law kernel |x|**(-2/alpha), normalized so that the moments of the flux scale with the UM moment scaling function K(q) = C_1/(alpha-1)*(q**alpha - q) from the pixel scale up to the `outer_scale'. The field is then obtained by the fractional integration of the flux of the order H (the convolution with |x|**(H-2)), so that its increments scale with H. The convolutions are done by FFT, i.e. in O(N log N) operations for N pixels, the field is periodic. The `latitudes' (in degrees) shorten the longitudal pixel distance by the cosine of their mean (as the flux computation of multifractal_scaling_essential_pub does), the `land' (boolean array) pixels take the masking value.
+
+
+
+import numpy as np
+from scipy import fft
+import multifractal_parameter_values_pub as pa
+
+
+
+# Extremal (maximally skewed to the left, beta = -1) alpha-stable random variables of the unit scale, by the Chambers-Mallows-Stuck method. For alpha < 1 they are negative, for alpha > 1 they have the heavy tail on the negative side only, so their exponentials have all the positive moments. (alpha = 1 is replaced by the nearby index, where the method is numerically stable.)
+
+def extremal_levy(alpha, size, generator):
+
+    if abs(alpha - 1) < 1e-3:
+        alpha = 1 + 1e-3
+
+    if alpha == 2:
+        return np.sqrt(2.0)*generator.standard_normal(size)
+
+    angle = np.pi*(generator.random(size) - 0.5)
+    exponential = generator.standard_exponential(size)
+
+    tangent = np.tan(np.pi*alpha/2.0)
+    shift = np.arctan(-tangent)/alpha
+    scale = (1 + tangent**2)**(1/(2*alpha))
+
+    return scale*np.sin(alpha*(angle + shift))/np.cos(angle)**(1/alpha)*(np.cos(angle - alpha*(angle + shift))/exponential)**((1 - alpha)/alpha)
+
+
+
+# The periodic distances of the pixels from the origin (the longitudal distance is multiplied by the `geometric_factor'), the distance of the origin itself is 1 (the pixel scale).
+
+def periodic_distance(shape, geometric_factor = 1.0):
+
+    lat = np.minimum(np.arange(0, shape[0]), shape[0] - np.arange(0, shape[0]))
+    lon = np.minimum(np.arange(0, shape[1]), shape[1] - np.arange(0, shape[1]))*geometric_factor
+
+    return np.maximum(np.sqrt(lat[:, np.newaxis]**2 + lon[np.newaxis, :]**2), 1.0)
+
+
+
+# The periodic convolution of the field with the kernel (both of the same shape) by FFT.
+
+def convolve(field, kernel):
+
+    return fft.irfft2(fft.rfft2(field, workers=-1)*fft.rfft2(kernel, workers=-1), s=np.shape(field), workers=-1)
+
+
+
+# The UM flux with the parameters alpha, C_1 (the mean of the flux is 1). The `outer_scale' (in pixels, by default the larger side of the grid) is where the cascade starts.
+
+def UM_flux(shape, alpha, C_1, outer_scale = None, seed = None, geometric_factor = 1.0):
+
+    generator = np.random.default_rng(seed)
+    outer_scale = max(shape) if outer_scale is None else outer_scale
+
+# The kernel truncated at the outer scale. Its value at the origin stands for the singularity integrated over the pixel (kernel**alpha = 4*pi, i.e. the pixel average of |x|**(-2/alpha) for alpha = 2), without it the flux would be too smooth at the smallest scales. The noise scale is set so that the log-flux gains C_1*|cos(pi*alpha/2)|/|alpha-1| of the Levy scale (to the power alpha) per unit of log(scale), the flux is then normalized by the Laplace transform of the extremal Levy variables.
+
+    distance = periodic_distance(shape, geometric_factor)
+    kernel = distance**(-2.0/alpha)*(distance <= outer_scale)
+    kernel[0, 0] = (4*np.pi)**(1.0/alpha)
+
+    if abs(alpha - 1) < 1e-3:
+        alpha = 1 + 1e-3
+
+    if alpha == 2:
+        ratio = 1.0
+    else:
+        ratio = abs(np.cos(np.pi*alpha/2.0))/abs(alpha - 1)
+
+    noise_scale = (C_1*ratio*geometric_factor/(2*np.pi))**(1/alpha)
+    generator_field = convolve(noise_scale*extremal_levy(alpha, shape, generator), kernel)
+
+    if alpha == 2:
+        log_mean = noise_scale**2*np.sum(kernel**2)
+    else:
+        log_mean = -noise_scale**alpha*np.sum(kernel**alpha)/np.cos(np.pi*alpha/2.0)
+
+    return np.exp(generator_field - log_mean)
+
+
+
+# The fractional integration of the order H (the convolution with the kernel |x|**(H-2), normalized to keep the mean). For H > 0 the positive flux gives the positive field, H = 0 returns the flux, for H < 0 (the fractional differentiation) the Fourier filter |k|**(-H) is used and the field can take negative values.
+
+def fractional_integration(flux, H, geometric_factor = 1.0):
+
+    if H == 0:
+        return np.array(flux)
+
+    if H > 0:
+        kernel = periodic_distance(np.shape(flux), geometric_factor)**(H - 2)
+        kernel[0, 0] = 2*np.sqrt(np.pi)**(2 - H)/H    # the kernel integrated over the pixel (the disk of the unit area)
+        return convolve(flux, kernel/np.sum(kernel))
+
+    frequency_lat = fft.fftfreq(np.shape(flux)[0])
+    frequency_lon = fft.rfftfreq(np.shape(flux)[1])/geometric_factor
+    frequency = np.sqrt(frequency_lat[:, np.newaxis]**2 + frequency_lon[np.newaxis, :]**2)
+    frequency[0, 0] = 1.0
+    frequency = frequency/np.min(frequency[frequency > 0])    # the filter keeps the largest scales (and the mean)
+
+    return fft.irfft2(fft.rfft2(flux, workers=-1)*frequency**(-H), s=np.shape(flux), workers=-1)
+
+
+
+# The synthetic UM field of the shape (lat, lon) with the parameters H, alpha, C_1 (see UM_flux(...) and fractional_integration(...)). The `land' pixels (boolean array) take the `mask' value (by default pa.masking_value()). Note that for H = 0 (the flux) the extreme low values of the intermittent fields can come very close to zero. The same seed gives the same field.
+
+def UM_field(shape, H, alpha, C_1, outer_scale = None, seed = None, latitudes = None, land = None, mask = None):
+
+    mask = pa.masking_value() if mask is None else mask
+
+    if latitudes is None:
+        geometric_factor = 1.0
+    else:
+        geometric_factor = np.cos(np.pi*np.mean(latitudes)/180.0)
+
+    field = fractional_integration(UM_flux(shape, alpha, C_1, outer_scale, seed, geometric_factor), H, geometric_factor)
+
+    if land is not None:
+        field[land] = mask
+
+    return field
+
+
+
+# A land mask (boolean array, True is land) covering the `fraction' of the pixels: the smooth random blob pattern (Gaussian-filtered white noise, with the blob size `smoothness' in pixels, thresholded at its quantile).
+
+def land_mask(shape, fraction, seed = None, smoothness = None):
+
+    generator = np.random.default_rng(seed)
+    smoothness = max(shape)/16.0 if smoothness is None else smoothness
+    frequency_lat = fft.fftfreq(shape[0])
+    frequency_lon = fft.rfftfreq(shape[1])
+    noise = fft.irfft2(fft.rfft2(generator.standard_normal(shape))*np.exp(-(frequency_lat[:, np.newaxis]**2 + frequency_lon[np.newaxis, :]**2)*(np.pi*smoothness)**2*2), s=shape)
+
+    return noise <= np.quantile(noise, fraction)